@@ -1,65 +1,2375 @@
 """Intelligently search Python source code"""
 import astcheck, ast
 from astcheck import assert_ast_like
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED,
+)
+import functools
+import hashlib
+import heapq
+from io import BytesIO
+from itertools import chain, islice
 import os.path
+import pickle
+import re
+import struct
 import sys
+from time import perf_counter, time
 import tokenize
 import warnings
+import zlib
 
 __version__ = '0.2.0'
 
+def _all_subclasses(cls):
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from _all_subclasses(sub)
+
+@functools.lru_cache()
+def _node_child_types():
+    """Map AST node classes to the node classes their fields can hold
+
+    This is worked out from the grammar signatures in the docstrings of the
+    node classes, e.g. ``If(expr test, stmt* body, stmt* orelse)``. Classes
+    which don't have such a signature (deprecated & abstract classes) are left
+    out.
+    """
+    signature = re.compile(r'(\w+)(?:\((.*)\))?$')
+    child_types = {}
+    for cls in _all_subclasses(ast.AST):
+        m = signature.match(cls.__doc__ or '')
+        if not m or m.group(1) != cls.__name__:
+            continue
+        children = set()
+        for field in filter(None, (m.group(2) or '').split(',')):
+            typename = field.split()[0].rstrip('*?')
+            fieldcls = getattr(ast, typename, None)
+            if isinstance(fieldcls, type) and issubclass(fieldcls, ast.AST):
+                children.add(fieldcls)
+                children.update(_all_subclasses(fieldcls))
+        child_types[cls] = children
+
+    # Deprecated classes like ast.Num are subclasses of real node classes,
+    # but the parser never produces them.
+    for cls, children in child_types.items():
+        children.intersection_update(child_types)
+    return child_types
+
+@functools.lru_cache()
+def _barren_types(nodetypes):
+    """Find node classes whose subtrees can't contain any of nodetypes"""
+    child_types = _node_child_types()
+
+    def is_target(cls):
+        return issubclass(cls, nodetypes)
+
+    # Start from all the known classes, and remove those which could contain
+    # one of the targets, until nothing changes.
+    barren = set(child_types)
+    changed = True
+    while changed:
+        changed = False
+        for cls in list(barren):
+            if any(is_target(c) or c not in barren for c in child_types[cls]):
+                barren.discard(cls)
+                changed = True
+    return frozenset(barren)
+
+def walk_pruned(tree, nodetypes, max_depth=None, stop=None):
+    """Walk an AST like :func:`ast.walk`, skipping subtrees which can't contain
+    nodes of the given types.
+
+    :param ast.AST tree: The AST to walk
+    :param nodetypes: An AST node class, or a tuple of classes, as for
+      :func:`isinstance`
+    :param int max_depth: If given, don't descend into statements nested more
+      than this many levels deep. Module-level statements are at depth 0, the
+      body of a class or function at the top level is at depth 1, and so on.
+      Expressions are at the same depth as the statement they're part of.
+    :param stop: Optional function taking a node; if it returns True, the node
+      is yielded but its subtree isn't walked.
+
+    For instance, statements can't appear inside expressions, so a search for
+    function definitions doesn't need to look inside any expression. Nodes are
+    yielded in the same order as :func:`ast.walk`, but some nodes which can't
+    be of the given types are also skipped.
+    """
+    if not isinstance(nodetypes, tuple):
+        nodetypes = (nodetypes,)
+    nodetypes = tuple(t for t in nodetypes
+                      if isinstance(t, type) and issubclass(t, ast.AST))
+    barren = _barren_types(nodetypes)
+
+    todo = deque([(tree, 0)])
+    while todo:
+        node, depth = todo.popleft()
+        yield node
+        if type(node) in barren:
+            continue  # A target, but nothing inside it can be
+        if stop is not None and stop(node):
+            continue
+        stmt_parent = not isinstance(node, ast.mod)
+        for child in ast.iter_child_nodes(node):
+            if type(child) in barren and not isinstance(child, nodetypes):
+                continue
+            child_depth = depth
+            if stmt_parent and isinstance(child, ast.stmt):
+                child_depth += 1
+                if max_depth is not None and child_depth > max_depth:
+                    continue
+            todo.append((child, child_depth))
+
 class ASTPatternFinder(object):
     """Scans Python code for AST nodes matching pattern.
 
-    :param ast.AST pattern: The node pattern to search for
+    :param pattern: The node pattern to search for, as an :class:`ast.AST`
+      or a :class:`CompiledPattern`
+    :param ASTCache cache: Optional cache of parsed files, used when scanning
+      files by path
+    :param int max_depth: Only search statements nested up to this many levels
+      deep; see :func:`walk_pruned`
+    :param ScanHooks hooks: Optional callbacks on the progress of searches
+      through files
+    :param ASTIndex index: Optional index of the terms in each file, used by
+      :meth:`iter_files` to skip files which can't match
+    :param within: Optional pattern for the enclosing code to search in, as
+      an :class:`ast.AST` or a :class:`CompiledPattern`; see :meth:`scan_ast`
     """
-    def __init__(self, pattern):
-        self.pattern = pattern
+    def __init__(self, pattern, cache=None, max_depth=None, hooks=None,
+                 index=None, within=None):
+        if not isinstance(pattern, CompiledPattern):
+            pattern = CompiledPattern(pattern)
+        if within is not None and not isinstance(within, CompiledPattern):
+            within = CompiledPattern(within)
+        self.compiled = pattern
+        self.pattern = pattern.pattern
+        self.cache = cache
+        self.max_depth = max_depth
+        self.hooks = hooks
+        self.index = index
+        self.within = within
+        self.matcher = pattern.matcher
+        self.literals = pattern.literals
+        if within is not None:
+            # A file must contain the names from both patterns
+            self.literals = self.literals | within.literals
+        # Check longer names first, as they're less likely to occur by chance
+        self._literal_bytes = sorted((l.encode('ascii') for l in self.literals),
+                                     key=len, reverse=True)
+
+    def __getstate__(self):
+        # The generated matcher can't be pickled, and the pattern would be
+        # pickled twice; both come from the compiled pattern, which pickles
+        # as its text. Worker processes don't need the index, nor the hooks,
+        # which are only called in the parent process.
+        state = self.__dict__.copy()
+        del state['matcher'], state['pattern']
+        state['index'] = state['hooks'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pattern = self.compiled.pattern
+        self.matcher = self.compiled.matcher
+
+    def may_match(self, source):
+        """Quickly check if source code could contain a match for the pattern
+
+        This looks for the names in :attr:`literals` in the raw source, without
+        parsing it. A False result means the pattern can't match; True means
+        the source needs to be parsed to find out.
+
+        :param source: Python source code, as bytes or str
+        """
+        if isinstance(source, bytes):
+            return all(l in source for l in self._literal_bytes)
+        return all(l in source for l in self.literals)
 
     def scan_ast(self, tree):
         """Walk an AST and yield nodes matching pattern.
 
         :param ast.AST tree: The AST in which to search
+
+        If the finder was given a *within* pattern, this first looks for
+        nodes matching that, and only searches inside them (not including
+        the enclosing nodes themselves). Parts of the tree outside those
+        scopes aren't checked against the pattern at all. *max_depth* then
+        limits how deep to look for the enclosing scopes; everything inside
+        them is searched.
         """
+        if self.within is None:
+            yield from self._scan_tree(tree, self.max_depth)
+            return
+        for scope in self._iter_scopes(tree):
+            for child in ast.iter_child_nodes(scope):
+                yield from self._scan_tree(child)
+
+    def _iter_scopes(self, tree):
+        """Yield the outermost nodes matching the within pattern"""
+        scopetype = type(self.within.pattern)
+        matcher = self.within.matcher
+
+        def is_scope(node):
+            return isinstance(node, scopetype) and matcher(node)
+
+        # Scopes inside a matching scope are searched as part of it, so the
+        # walk doesn't go into them.
+        for node in walk_pruned(tree, scopetype, self.max_depth, stop=is_scope):
+            if is_scope(node):
+                yield node
+
+    def _scan_tree(self, tree, max_depth=None):
         nodetype = type(self.pattern)
-        for node in ast.walk(tree):
-            if isinstance(node, nodetype) and astcheck.is_ast_like(node, self.pattern):
+        matcher = self.matcher
+        for node in walk_pruned(tree, nodetype, max_depth):
+            if isinstance(node, nodetype) and matcher(node):
                 yield node
 
     def scan_file(self, file):
         """Parse a file and yield AST nodes matching pattern.
 
         :param file: Path to a Python file, or a readable file object
+
+        Files which don't contain all the names in :attr:`literals` are skipped
+        without being parsed.
+        """
+        tree, _ = self._load(file)
+        if tree is not None:
+            yield from self.scan_ast(tree)
+
+    def _load(self, file, times=None):
+        """Read & parse a file, returning (tree, source)
+
+        tree is None if the file was skipped because it can't match. source is
+        a :class:`SourceBuffer`, sharing the bytes read for parsing. If a dict
+        is passed as *times*, the time after reading and after parsing are
+        stored in it.
         """
         if isinstance(file, str):
+            if self.cache is not None:
+                # The source is only read if it's needed, so the time to read
+                # files which aren't cached is counted as parsing.
+                tree = self.cache.parse(file, self.may_match)
+                if times is not None:
+                    times['read' if tree is None else 'parse'] = perf_counter()
+                return tree, SourceBuffer(file)
             with open(file, 'rb') as f:
-                tree = ast.parse(f.read())
+                data = f.read()
+            source = SourceBuffer(file, data)
         else:
-            tree = ast.parse(file.read())
-        yield from self.scan_ast(tree)
+            data = file.read()
+            source = SourceBuffer(None, data)
+        if times is not None:
+            times['read'] = perf_counter()
+        if not self.may_match(data):
+            return None, source
+        tree = ast.parse(data)
+        if times is not None:
+            times['parse'] = perf_counter()
+        return tree, source
 
     def filter_subdirs(self, dirnames):
         dirnames[:] = [d for d in dirnames if d != 'build']
 
-    def scan_directory(self, directory):
+    def iter_files(self, directory, git=False, gitignore=False, exclude=(),
+                   include=(), skip_venvs=True, shard=None, shard_by_size=False):
+        """Walk a directory, yielding the paths of Python files to scan.
+
+        :param str directory: Path to a directory to search
+        :param bool git: Get the list of files from git (see :func:`git_files`)
+          instead of walking the directory. Subdirectories are then not
+          filtered by :meth:`filter_subdirs`.
+        :param bool gitignore: Skip files & directories matched by patterns in
+          ``.gitignore`` files found while walking the directory.
+        :param list exclude: Glob patterns for files & directories to skip
+        :param list include: Glob patterns for files to scan; if given, only
+          files matching at least one of them are included.
+        :param bool skip_venvs: Skip subdirectories containing a
+          ``pyvenv.cfg`` file, i.e. virtualenvs.
+        :param tuple shard: (i, n) to only yield the i-th of n disjoint
+          subsets of the files, counting from 1; see :func:`shard_files`
+        :param bool shard_by_size: Balance shards by file size, rather than
+          by the number of files
+
+        If the finder has an :class:`ASTIndex` for *directory*, files which
+        the index shows can't match are skipped without being opened.
+
+        Only files with a ``.py`` or ``.pyw`` extension are included. Glob
+        patterns work as in ``.gitignore`` files: a pattern containing a ``/``
+        is matched against the path relative to *directory*, while one without
+        is matched against the name at any level.
+
+        Symlinks to directories are not followed. Each physical file is only
+        yielded once, even if it can be reached by several paths, e.g. through
+        bind mounts or hard links.
+        """
+        files = self._walk_files(directory, git, gitignore, exclude, include,
+                                 skip_venvs)
+        if shard is not None:
+            files = shard_files(files, directory, *shard, by_size=shard_by_size)
+        if self.index is not None \
+                and os.path.abspath(directory) == self.index.directory:
+            candidates = self._index_candidates()
+            if candidates is not None:
+                files = self.index.filter(files, candidates)
+        yield from files
+
+    def _index_terms(self, pattern):
+        terms = pattern_index_terms(pattern)
+        if self.within is not None:
+            terms |= pattern_index_terms(self.within.pattern)
+        return terms
+
+    def _index_candidates(self):
+        return self.index.candidates(self._index_terms(self.pattern))
+
+    def _walk_files(self, directory, git, gitignore, exclude, include,
+                    skip_venvs):
+        """List files for iter_files, before sharding"""
+        exclude_re = _compile_globs(exclude)
+        include_re = _compile_globs(include)
+
+        def matches(relpath, patterns_re):
+            return patterns_re is not None and patterns_re.match(relpath)
+
+        if git:
+            for filepath in git_files(directory):
+                relpath = os.path.relpath(filepath, directory).replace(os.sep, '/')
+                if not matches(relpath, exclude_re) and \
+                        (include_re is None or matches(relpath, include_re)):
+                    yield filepath
+            return
+
+        ignore = GitIgnore() if gitignore else None
+        seen = set()
+        # Relative paths are only needed to match glob patterns
+        use_globs = exclude_re is not None or include_re is not None
+        # Directories to walk, with their paths relative to directory (using
+        # '/'), and (with gitignore) markers with a prefix of None to unload
+        # each directory's patterns once its subdirectories are done.
+        todo = [(directory, '')]
+        while todo:
+            dirpath, relprefix = todo.pop()
+            if relprefix is None:
+                ignore.unload(dirpath)
+                continue
+            try:
+                dir_dev = os.stat(dirpath).st_dev
+                with os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError:
+                continue  # e.g. permission denied, like os.walk
+            if skip_venvs and dirpath != directory \
+                    and any(e.name == 'pyvenv.cfg' for e in entries):
+                continue
+            if ignore is not None:
+                ignore.load(dirpath)
+                todo.append((dirpath, None))
+
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not is_dir and not entry.name.endswith(('.py', '.pyw')):
+                        continue
+                    if is_dir and ignore is not None and entry.name == '.git':
+                        continue  # Git's own files are never part of the tree
+                    relpath = relprefix + entry.name if use_globs else None
+                    if matches(relpath, exclude_re) or (ignore is not None
+                            and ignore.ignored(entry.path, is_dir=is_dir)):
+                        continue
+                    if is_dir:
+                        subdirs.append(entry)
+                        continue
+                    if include_re is not None and not matches(relpath, include_re):
+                        continue
+                    # Regular files are on the same device as their directory,
+                    # so only symlinks need an extra stat call
+                    if entry.is_symlink():
+                        st = entry.stat()
+                        key = (st.st_dev, st.st_ino)
+                    else:
+                        key = (dir_dev, entry.inode())
+                except OSError:
+                    continue  # e.g. broken symlink
+                if key not in seen:
+                    seen.add(key)
+                    yield entry.path
+
+            dirnames = [e.name for e in subdirs]
+            self.filter_subdirs(dirnames)
+            keep = set(dirnames)
+            # Reversed, so that directories are popped in the order listed
+            for entry in reversed(subdirs):
+                if entry.name not in keep:
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    todo.append((entry.path, relprefix + entry.name + '/'))
+
+    def scan_directory(self, directory, jobs=1, max_per_file=None, max_count=None,
+                       records=False, dedup=False, **walk_options):
         """Walk files in a directory, yielding (filename, node) pairs matching
         pattern.
 
         :param str directory: Path to a directory to search
 
         Only files with a ``.py`` or ``.pyw`` extension will be scanned.
+        *jobs*, *max_per_file*, *max_count*, *records* and *dedup* are as for
+        :meth:`scan_files`; other keyword arguments, such as *git*, are passed
+        to :meth:`iter_files`.
         """
-        for dirpath, dirnames, filenames in os.walk(directory):
-            self.filter_subdirs(dirnames)
+        yield from self.scan_files(self.iter_files(directory, **walk_options),
+                                   jobs=jobs, max_per_file=max_per_file,
+                                   max_count=max_count, records=records,
+                                   dedup=dedup)
+
+    def scan_archive(self, path, **kwargs):
+        """Search the Python files in a wheel, zip or tar archive, yielding
+        (name, node) pairs matching pattern.
+
+        :param str path: Path to the archive; see :func:`iter_archive`
+
+        Files are read from the archive in memory, without extracting it, and
+        named like ``archive.whl!package/module.py``. Keyword arguments are
+        passed to :meth:`scan_files`.
+        """
+        yield from self.scan_files(iter_archive(path), **kwargs)
+
+    def scan_git_history(self, directory, revs, **kwargs):
+        """Search the Python files in a range of git commits, yielding
+        (commit, path, node) tuples for matches.
+
+        :param str directory: A directory inside a git working tree
+        :param revs: A revision range, e.g. ``'v1.0..main'``; see
+          :class:`GitHistory`
+
+        Each distinct version of a file is parsed once, and its matches are
+        reported for every commit containing that version. Keyword arguments
+        are passed to :meth:`scan_files`; *max_count* counts matches in
+        distinct file versions.
+        """
+        history = GitHistory(directory, revs)
+        for result in self.iter_file_matches(history.iter_sources(), **kwargs):
+            for commit, path in history.blobs[result.path]:
+                for match in result.matches:
+                    yield commit, path, match
+
+    def scan_files(self, filepaths, jobs=1, max_per_file=None, max_count=None,
+                   records=False, dedup=False):
+        """Scan a series of files, yielding (filename, node) pairs matching
+        pattern.
+
+        :param filepaths: Iterable of paths to Python files. Items may also be
+          (name, source bytes) pairs, e.g. from :func:`iter_archive`, to scan
+          code which isn't in a file of its own.
+        :param int jobs: Number of worker processes to use. The default, 1,
+          scans files one at a time in this process. With more than one job,
+          files are parsed and matched in a pool of processes, and results are
+          yielded in the order files finish, not the order they were given.
+          0 means one job per CPU.
+        :param int max_per_file: Stop searching each file after this many
+          matches, e.g. 1 to find which files match.
+        :param int max_count: Stop the whole search after this many matches.
+        :param bool records: Yield compact :class:`Match` records, which
+          include the filename, instead of (filename, node) pairs. The AST of
+          each file can then be freed as soon as it has been searched.
+        :param bool dedup: Read and hash each file before parsing it, and only
+          parse & search each distinct content once. Files with the same
+          content as one already searched get copies of its matches, as if
+          they had been searched themselves.
+
+        All the matches from one file are yielded together.
+        """
+        for result in self.iter_file_matches(filepaths, jobs=jobs,
+                                             max_per_file=max_per_file,
+                                             max_count=max_count,
+                                             records=records, dedup=dedup):
+            if records:
+                yield from result.matches
+            else:
+                for match in result.matches:
+                    yield result.path, match
+
+    def iter_file_matches(self, filepaths, jobs=1, max_per_file=None,
+                          max_count=None, records=False, dedup=False):
+        """Scan a series of files, yielding a :class:`FileMatches` object for
+        each file with matches.
+
+        This takes the same parameters as :meth:`scan_files`. Each result has
+        the source of the file as a :class:`SourceBuffer`, so that the lines
+        which matched can be shown without opening the file again. With
+        *records*, its matches are :class:`Match` records rather than nodes;
+        these are made in the worker process when using several jobs, so
+        ASTs aren't sent between processes.
+
+        With *dedup*, a copy of a file gets a result sharing the original's
+        source and, unless *records* is used, its AST nodes. Copies are
+        reported to the hooks as files skipped without parsing. Files are read
+        in this process to hash them, and their contents passed on to the
+        workers, except when using a cache, which reads the files itself.
+        """
+        if max_count == 0:
+            return
+        hooks = self.hooks
+        timed = hooks is not None
+        if timed:
+            filepaths = _announce_files(filepaths, hooks)
+        if dedup:
+            contents = _ContentGroups()
+            filepaths = contents.unique(filepaths,
+                                        keep_paths=self.cache is not None)
+
+        remaining = max_count
+        if jobs == 1:
+            # The limit is recalculated for each file, as remaining goes down
+            results = (self._scan_path(p, _min_limit(max_per_file, remaining),
+                                       timed, records)
+                       for p in filepaths)
+        else:
+            results = self._scan_parallel(filepaths, jobs or os.cpu_count(),
+                                          max_per_file, timed, records)
+        if dedup:
+            results = contents.expand(results)
+
+        for result in results:
+            remaining = self._finish_result(result, remaining)
+            if not result.matches:
+                continue
+            yield result
+            if remaining == 0:
+                return
+
+    def _finish_result(self, result, remaining):
+        """Warn about a parse failure, apply the overall limit on matches, and
+        call the hooks for one file. Returns the number of matches remaining.
+        """
+        if result.error is not None:
+            warnings.warn("Failed to parse {}:\n{}".format(result.path,
+                                                          result.error))
+        if remaining is not None:
+            del result.matches[remaining:]
+            remaining -= len(result.matches)
+        if self.hooks is not None:
+            _call_hooks(self.hooks, result)
+        return remaining
+
+    async def ascan_directory(self, directory, executor=None, max_per_file=None,
+                              max_count=None, queue_size=16, records=False,
+                              **walk_options):
+        """Walk files in a directory, asynchronously yielding (filename, node)
+        pairs matching pattern.
+
+        This is an async generator, for use with ``async for``. It takes the
+        same parameters as :meth:`aiter_file_matches`, and keyword arguments
+        for :meth:`iter_files`. With *records*, it yields :class:`Match`
+        records, as :meth:`scan_files` does.
+        """
+        async for result in self.aiter_file_matches(
+                self.iter_files(directory, **walk_options), executor=executor,
+                max_per_file=max_per_file, max_count=max_count,
+                queue_size=queue_size, records=records):
+            if records:
+                for match in result.matches:
+                    yield match
+            else:
+                for match in result.matches:
+                    yield result.path, match
+
+    async def aiter_file_matches(self, filepaths, executor=None,
+                                 max_per_file=None, max_count=None,
+                                 queue_size=16, records=False):
+        """Scan a series of files, asynchronously yielding a
+        :class:`FileMatches` object for each file with matches.
+
+        :param filepaths: Iterable of paths to Python files
+        :param executor: A :class:`concurrent.futures.Executor` to read, parse
+          and match files in. The default is the event loop's default thread
+          pool. With a process pool, the finder is pickled for each file.
+        :param int max_per_file: Stop searching each file after this many
+          matches.
+        :param int max_count: Stop the whole search after this many matches.
+        :param int queue_size: How many files may be queued in the executor at
+          once. The next files are only started as results are consumed.
+        :param bool records: Give matches as :class:`Match` records, as for
+          :meth:`iter_file_matches`.
+
+        The event loop is never blocked: listing files happens in the default
+        thread pool, and scanning in *executor*. Results come in the order of
+        *filepaths*. If the consumer stops iterating, queued files are
+        cancelled; use :func:`contextlib.aclosing` (or close the generator)
+        to make this happen right away when breaking out of the loop.
+        """
+        if max_count == 0:
+            return
+        import asyncio
+        loop = asyncio.get_running_loop()
+        timed = self.hooks is not None
+        files = iter(filepaths)
+        pending = deque()
+        files_left = True
+        remaining = max_count
+        try:
+            while True:
+                if files_left and len(pending) < queue_size:
+                    batch = await loop.run_in_executor(
+                        None, _take, files, queue_size - len(pending))
+                    files_left = bool(batch)
+                    for filepath in batch:
+                        if timed:
+                            self.hooks.on_file_start(_source_name(filepath))
+                        pending.append(loop.run_in_executor(
+                            executor, self._scan_path, filepath,
+                            _min_limit(max_per_file, remaining), timed,
+                            records))
+                if not pending:
+                    return
+                result = await pending.popleft()
+                remaining = self._finish_result(result, remaining)
+                if result.matches:
+                    yield result
+                    if remaining == 0:
+                        return
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _scan_path(self, filepath, limit=None, timed=False, records=False):
+        """Scan one file, returning a FileMatches object
+
+        If timed is True, the result's timings attribute records when each
+        step finished. If records is True, matches are turned into
+        :class:`Match` records, so the AST can be freed.
+        """
+        times = {'start': perf_counter()} if timed else None
+        if isinstance(filepath, tuple):
+            filepath, data = filepath
+            file = BytesIO(data)
+        else:
+            file = filepath
+        try:
+            tree, source = self._load(file, times)
+        except SyntaxError as e:
+            return FileMatches(filepath, None, [], e, times)
+        if tree is None:
+            return FileMatches(filepath, None, [], timings=times)
+        matches = list(islice(self.scan_ast(tree), limit))
+        if records:
+            matches = [self._make_record(filepath, m) for m in matches]
+        if timed:
+            times['match'] = perf_counter()
+        # Only hold on to the source if we might need to show it
+        return FileMatches(filepath, source if matches else None, matches,
+                           timings=times)
+
+    def _make_record(self, filepath, node):
+        return Match.from_node(filepath, node)
+
+    def _scan_parallel(self, filepaths, jobs, max_per_file=None, timed=False,
+                       records=False, chunksize=8):
+        """Scan files in a process pool, yielding results as they finish"""
+        executor = ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                       initargs=(self,))
+        try:
+            pending = set()
+            for chunk in _chunked(filepaths, chunksize):
+                pending.add(executor.submit(_scan_in_worker, chunk, max_per_file,
+                                            timed, records))
+                # Keep a few chunks queued per worker, so that we neither
+                # starve the pool nor read the whole file list up front.
+                if len(pending) >= jobs * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+
+            for future in as_completed(pending):
+                yield from future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def git_files(directory):
+    """List the Python files in a git working tree, using ``git ls-files``
+
+    :param str directory: A directory inside a git working tree
+
+    This includes files tracked in the git index and untracked files which
+    aren't ignored, under *directory*. Tracked files which have been deleted
+    are left out. Raises :exc:`subprocess.CalledProcessError` if *directory*
+    is not in a git working tree.
+    """
+    import subprocess
+
+    def ls_files(*options):
+        out = subprocess.run(
+            ['git', 'ls-files', '-z'] + list(options) + ['--', '*.py', '*.pyw'],
+            cwd=directory, stdout=subprocess.PIPE, check=True,
+        ).stdout
+        return [os.fsdecode(p) for p in out.split(b'\0') if p]
+
+    deleted = set(ls_files('--deleted'))
+    for relpath in ls_files('--cached', '--others', '--exclude-standard'):
+        if relpath not in deleted:
+            yield os.path.join(directory, relpath)
+
+def read_paths(stream, null=False):
+    """Read a list of paths from a binary stream, one at a time
+
+    :param stream: A binary file-like object, such as ``sys.stdin.buffer``
+    :param bool null: Paths are separated by NUL characters (as from
+      ``find -print0`` or ``git diff -z``), rather than newlines
+
+    Each path is yielded as soon as its separator has been read, so a search
+    can start while another program is still writing the list. Empty entries
+    are skipped; with newline separators, a trailing ``\\r`` is removed.
+    """
+    sep = b'\0' if null else b'\n'
+    # read1() returns whatever is available, rather than waiting to fill
+    # the buffer, where the stream supports it.
+    read = getattr(stream, 'read1', None) or stream.read
+    pending = b''
+    while True:
+        data = read(65536)
+        if not data:
+            break
+        *complete, pending = (pending + data).split(sep)
+        for entry in complete:
+            if not null:
+                entry = entry.rstrip(b'\r')
+            if entry:
+                yield os.fsdecode(entry)
+    if not null:
+        pending = pending.rstrip(b'\r')
+    if pending:
+        yield os.fsdecode(pending)
+
+def shard_files(filepaths, directory, index, count, by_size=False):
+    """Select a stable subset of files, to split a search between machines
+
+    :param filepaths: Iterable of paths to files under *directory*
+    :param str directory: The directory the search started from; files are
+      assigned to shards by their path relative to it
+    :param int index: Which shard to select, from 1 to *count*
+    :param int count: The number of shards
+    :param bool by_size: Balance the total size of the files in each shard
+
+    Each file is in exactly one shard, and the same file goes to the same
+    shard on any machine, as long as the searches start from copies of the
+    same directory. By default, files are assigned by a hash of their relative
+    path, which doesn't need to look at the other files. With *by_size*, all
+    the files are listed and their sizes checked first, and each file, from
+    the largest down, goes to the shard with the least data so far. The files
+    in the directory must then be the same for every shard.
+    """
+    if not 1 <= index <= count:
+        raise ValueError("Shard must be between 1 and {}, not {}".format(
+            count, index))
+
+    def relpath(filepath):
+        return os.path.relpath(filepath, directory).replace(os.sep, '/')
+
+    if not by_size:
+        for filepath in filepaths:
+            if zlib.crc32(relpath(filepath).encode('utf-8')) % count == index - 1:
+                yield filepath
+        return
+
+    sized = sorted(((os.stat(p).st_size, relpath(p), p) for p in filepaths),
+                   key=lambda f: (-f[0], f[1]))
+    totals = [(0, i) for i in range(count)]  # Heap of (total size, shard)
+    mine = []
+    for size, rel, filepath in sized:
+        total, shard = heapq.heappop(totals)
+        heapq.heappush(totals, (total + size, shard))
+        if shard == index - 1:
+            mine.append((rel, filepath))
+    for rel, filepath in sorted(mine):
+        yield filepath
+
+def merge_jsonl(infiles, outfile):
+    """Combine JSON Lines results, e.g. from several shards, into one report
+
+    :param infiles: Text file objects with output from ``--format jsonl``
+    :param outfile: A text file object to write the merged records to
+
+    Records are sorted by path, then position in the file, then rule name, so
+    merging the results from all the shards of a search gives the same output
+    however the work was divided. Blank lines are skipped.
+    """
+    import json
+    records = []
+    for infile in infiles:
+        for line in infile:
+            if line.strip():
+                records.append(json.loads(line))
+
+    def sort_key(r):
+        return (r.get('path', ''), r.get('lineno', 0), r.get('col_offset', 0),
+                r.get('rule') or '')
+
+    records.sort(key=sort_key)
+    for record in records:
+        outfile.write(json.dumps(record) + '\n')
+
+class _GitObjectReader(object):
+    """Read objects from a git repository with ``git cat-file --batch``"""
+    def __init__(self, directory):
+        import subprocess
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     cwd=directory, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+    def read(self, ref):
+        """Returns (sha, type, data), or None if the object doesn't exist"""
+        self.proc.stdin.write(ref.encode('utf-8') + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:  # "<ref> missing"
+            return None
+        sha, objtype, size = header
+        data = self.proc.stdout.read(int(size))
+        self.proc.stdout.read(1)  # Newline after the contents
+        return sha.decode('ascii'), objtype.decode('ascii'), data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class GitHistory(object):
+    """The Python files in a range of git commits, deduplicated by content
+
+    :param str directory: A directory inside a git working tree; only files
+      under it are included
+    :param revs: A revision range as for ``git rev-list``, e.g.
+      ``'v1.0..main'``, or a list of such arguments
+
+    Files are read straight from git's object store, without checking out any
+    commits. Each distinct version of a file (a blob) is listed once, however
+    many commits contain it, and directories which didn't change between
+    commits are only read once.
+
+    .. attribute:: commits
+
+       The commit hashes in the range, newest first
+
+    .. attribute:: blobs
+
+       A dict mapping each blob hash to a list of (commit, path) pairs where
+       it occurs. Paths are relative to the root of the repository, so
+       ``commit:path`` can be passed to commands like ``git show``.
+    """
+    def __init__(self, directory, revs):
+        import subprocess
+        if isinstance(revs, str):
+            revs = [revs]
+
+        def git(*args):
+            return subprocess.run(['git'] + list(args), cwd=directory,
+                                  stdout=subprocess.PIPE, check=True,
+                                  ).stdout.decode('utf-8')
+
+        self.directory = directory
+        self.commits = git('rev-list', *revs, '--').split()
+        # The path of directory within the repository, e.g. 'src/'
+        prefix = git('rev-parse', '--show-prefix').strip()
+        self.blobs = {}
+        self._trees = {}
+        with _GitObjectReader(directory) as objects:
+            for commit in self.commits:
+                tree = objects.read('{}:{}'.format(commit, prefix))
+                if tree is None or tree[1] != 'tree':
+                    continue  # The directory doesn't exist in this commit
+                for path, blob in self._tree_files(objects, *tree):
+                    self.blobs.setdefault(blob, []).append((commit, prefix + path))
+        del self._trees
+
+    def _tree_files(self, objects, sha, objtype='tree', data=None):
+        """List (path, blob) pairs for Python files in a tree, recursively"""
+        try:
+            return self._trees[sha]
+        except KeyError:
+            pass
+        if data is None:
+            data = objects.read(sha)[2]
+        files = []
+        pos = 0
+        # Entries are '<mode> <name>\0' followed by a 20 byte binary hash
+        while pos < len(data):
+            space = data.index(b' ', pos)
+            nul = data.index(b'\0', space)
+            mode, name = data[pos:space], os.fsdecode(data[space + 1:nul])
+            entry_sha = data[nul + 1:nul + 21].hex()
+            pos = nul + 21
+            if mode == b'40000':
+                files.extend((name + '/' + path, blob) for path, blob
+                             in self._tree_files(objects, entry_sha))
+            elif mode in (b'100644', b'100755') \
+                    and name.endswith(('.py', '.pyw')):
+                files.append((name, entry_sha))
+        self._trees[sha] = files
+        return files
+
+    def iter_sources(self):
+        """Read each distinct file version, yielding (blob, source) pairs
+
+        These can be passed to :meth:`ASTPatternFinder.scan_files`, with the
+        blob hashes taking the place of filenames.
+        """
+        with _GitObjectReader(self.directory) as objects:
+            for blob in self.blobs:
+                yield blob, objects.read(blob)[2]
+
+class GitIgnore(object):
+    """Matches paths against patterns from ``.gitignore`` files
+
+    Call :meth:`load` for each directory as it is walked, from the top down,
+    so that patterns apply to the directory they were found in and below it,
+    and :meth:`unload` when the walk leaves it. Only the patterns from the
+    directories being walked are then checked for each path.
+
+    This handles the common parts of the gitignore format: comments,
+    negation with ``!``, directory-only patterns ending in ``/``, patterns
+    anchored by a ``/``, and ``*``, ``?``, ``[...]`` & ``**`` wildcards. It
+    doesn't read git's global or per-repository exclude files.
+    """
+    def __init__(self):
+        # (base directory, rules) for each loaded .gitignore file, outermost
+        # first. Each base uses '/' and ends with one; each rule is
+        # (compiled regex, negated, directory only).
+        self.rules = []
+
+    def load(self, directory):
+        """Load patterns from a ``.gitignore`` file in directory, if there is one"""
+        try:
+            with open(os.path.join(directory, '.gitignore'), encoding='utf-8',
+                      errors='surrogateescape') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        rules = [r for r in map(self._parse_line, lines) if r is not None]
+        if rules:
+            base = directory.replace(os.sep, '/').rstrip('/') + '/'
+            self.rules.append((base, rules))
+
+    def unload(self, directory):
+        """Drop the patterns loaded from directory, once it has been walked
+
+        Directories must be unloaded in the reverse order they were loaded.
+        """
+        base = directory.replace(os.sep, '/').rstrip('/') + '/'
+        if self.rules and self.rules[-1][0] == base:
+            self.rules.pop()
+
+    @staticmethod
+    def _parse_line(line):
+        if line.startswith('#'):
+            return None
+        line = re.sub(r'(?<!\\)\s+$', '', line)  # Unescaped trailing spaces
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            return None
+
+        # A slash at the start or middle anchors the pattern to the directory
+        # the .gitignore file is in; otherwise it can match at any level.
+        anchored = '/' in line
+        line = line.lstrip('/')
+        regex = _glob_to_regex(line)
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        return re.compile(regex + '$', re.DOTALL), negated, dir_only
+
+    def ignored(self, path, is_dir=False):
+        """Check if a path is ignored, by the last matching pattern"""
+        path = path.replace(os.sep, '/')
+        # Deeper .gitignore files and later lines take precedence, so the
+        # first match found going backwards decides.
+        for base, rules in reversed(self.rules):
+            if not path.startswith(base):
+                continue  # Not under the directory these rules came from
+            relpath = path[len(base):]
+            for regex, negated, dir_only in reversed(rules):
+                if (is_dir or not dir_only) and regex.match(relpath):
+                    return not negated
+        return False
+
+def _compile_globs(patterns):
+    """Combine gitignore-style glob patterns into one regex, or None"""
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        anchored = '/' in pattern.rstrip('/')
+        regex = _glob_to_regex(pattern.strip('/'))
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        regexes.append('(?:{})'.format(regex))
+    return re.compile('(?:{})$'.format('|'.join(regexes)), re.DOTALL)
+
+def _glob_to_regex(pattern):
+    """Translate a gitignore-style glob into a regex"""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        elif c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                parts.append(re.escape(c))
+            else:
+                chars = pattern[i + 1:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                parts.append('[' + chars.replace('\\', '\\\\') + ']')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+class MultiPatternFinder(ASTPatternFinder):
+    """Scans Python code for AST nodes matching any of several named patterns.
+
+    Each file is parsed and walked once, however many patterns there are. Each
+    node is only checked against the patterns with a matching node type.
+
+    :param dict patterns: Maps rule names to node patterns, as :class:`ast.AST`
+      or :class:`CompiledPattern` objects
+    :param ASTCache cache: Optional cache of parsed files, used when scanning
+      files by path
+    :param int max_depth: Only search statements nested up to this many levels
+      deep; see :func:`walk_pruned`
+    :param ScanHooks hooks: Optional callbacks on the progress of searches
+      through files
+    :param ASTIndex index: Optional index of the terms in each file, used by
+      :meth:`iter_files` to skip files which can't match
+    :param within: Optional pattern for the enclosing code to search in; see
+      :meth:`ASTPatternFinder.scan_ast`
+
+    Matches are reported with the name of the rule they matched: ``scan_ast``
+    and ``scan_file`` yield (rule_name, node) pairs, and ``scan_directory`` and
+    ``scan_files`` yield (rule_name, filename, node) tuples. A node matching
+    several rules is reported once for each.
+    """
+    def __init__(self, patterns, cache=None, max_depth=None, hooks=None,
+                 index=None, within=None):
+        if within is not None and not isinstance(within, CompiledPattern):
+            within = CompiledPattern(within)
+        self.compiled = {name: p if isinstance(p, CompiledPattern)
+                               else CompiledPattern(p)
+                         for name, p in dict(patterns).items()}
+        self.patterns = {name: c.pattern for name, c in self.compiled.items()}
+        self.cache = cache
+        self.max_depth = max_depth
+        self.hooks = hooks
+        self.index = index
+        self.within = within
+        self.matchers = {name: c.matcher for name, c in self.compiled.items()}
+        within_literals = within.literals if within is not None else set()
+        self.rule_literals = {name: set(c.literals | within_literals)
+                              for name, c in self.compiled.items()}
+        self._rule_literal_bytes = [[l.encode('ascii') for l in literals]
+                                    for literals in self.rule_literals.values()]
+        self._dispatch = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['matchers'], state['patterns']
+        state['_dispatch'] = {}
+        state['index'] = state['hooks'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.patterns = {name: c.pattern for name, c in self.compiled.items()}
+        self.matchers = {name: c.matcher for name, c in self.compiled.items()}
+
+    @property
+    def literals(self):
+        """The names common to all rules; see :func:`pattern_literals`"""
+        return set.intersection(*self.rule_literals.values()) \
+            if self.rule_literals else set()
+
+    def may_match(self, source):
+        """Quickly check if source code could contain a match for any rule"""
+        if isinstance(source, bytes):
+            return any(all(l in source for l in literals)
+                       for literals in self._rule_literal_bytes)
+        return any(all(l in source for l in literals)
+                   for literals in self.rule_literals.values())
+
+    def _rules_for_type(self, nodetype):
+        return [(name, self.matchers[name])
+                for name, pattern in self.patterns.items()
+                if isinstance(pattern, ast.AST)
+                and issubclass(nodetype, type(pattern))]
+
+    def scan_ast(self, tree):
+        """Walk an AST and yield (rule_name, node) pairs matching the rules.
+
+        :param ast.AST tree: The AST in which to search
+
+        A *within* pattern restricts the search as for
+        :meth:`ASTPatternFinder.scan_ast`.
+        """
+        yield from super().scan_ast(tree)
+
+    def _scan_tree(self, tree, max_depth=None):
+        dispatch = self._dispatch
+        nodetypes = tuple({type(p) for p in self.patterns.values()})
+        for node in walk_pruned(tree, nodetypes, max_depth):
+            nodetype = type(node)
+            try:
+                rules = dispatch[nodetype]
+            except KeyError:
+                rules = dispatch[nodetype] = self._rules_for_type(nodetype)
+            for name, matcher in rules:
+                if matcher(node):
+                    yield name, node
+
+    def scan_files(self, filepaths, records=False, **kwargs):
+        """Scan a series of files, yielding (rule_name, filename, node) tuples
+        for matches.
+
+        See :meth:`ASTPatternFinder.scan_files` for the parameters. With
+        *records*, this yields :class:`Match` records with the rule name in
+        their ``rule`` attribute.
+        """
+        if records:
+            yield from super().scan_files(filepaths, records=True, **kwargs)
+            return
+        for filepath, (name, node) in super().scan_files(filepaths, **kwargs):
+            yield name, filepath, node
+
+    def _make_record(self, filepath, match):
+        name, node = match
+        return Match.from_node(filepath, node, rule=name)
+
+    def _index_candidates(self):
+        candidates = set()
+        for pattern in self.patterns.values():
+            rule_candidates = self.index.candidates(self._index_terms(pattern))
+            if rule_candidates is None:
+                return None
+            candidates |= rule_candidates
+        return candidates
+
+# How much DuplicateFinder ignores when comparing code
+NORMALIZE_LEVELS = ('exact', 'names', 'literals')
+
+class DuplicateFinder(object):
+    """Finds repeated code by hashing the structure of every subtree
+
+    :param int min_size: Only report subtrees with at least this many nodes
+    :param str normalize: What differences to ignore: ``'exact'`` compares
+      everything but positions & formatting, ``'names'`` also ignores
+      identifiers (names, attributes, arguments, function names, etc.), and
+      ``'literals'`` also ignores the values of constants, though not their
+      types.
+    :param ASTCache cache: Optional cache of parsed files
+
+    Each distinct subtree structure gets an integer id, from a table keyed by
+    the node type, its normalized fields and the ids of its children
+    (hash-consing). Equal subtrees get equal ids, so finding all the clones
+    takes one pass over the code and a dict lookup per node, rather than
+    comparing subtrees with each other.
+    """
+    def __init__(self, min_size=20, normalize='names', cache=None):
+        if normalize not in NORMALIZE_LEVELS:
+            raise ValueError("normalize should be one of {}, not {!r}".format(
+                ', '.join(NORMALIZE_LEVELS), normalize))
+        self.min_size = min_size
+        self.normalize = normalize
+        self.cache = cache
+        self._ids = {}  # Structure key -> id
+        # id -> list of (Match or None, parent id), for subtrees >= min_size
+        self._occurrences = {}
+        self._sizes = {}  # id -> number of nodes, for subtrees >= min_size
+
+    def scan_files(self, filepaths):
+        """Add each file to the search; see :meth:`add_tree`
+
+        Items may be paths or (name, source bytes) pairs, as for
+        :meth:`ASTPatternFinder.scan_files`. Files which can't be parsed are
+        skipped with a warning.
+        """
+        for filepath in filepaths:
+            try:
+                if isinstance(filepath, tuple):
+                    filepath, data = filepath
+                    tree = ast.parse(data)
+                elif self.cache is not None:
+                    tree = self.cache.parse(filepath)
+                else:
+                    with open(filepath, 'rb') as f:
+                        tree = ast.parse(f.read())
+            except SyntaxError as e:
+                warnings.warn("Failed to parse {}:\n{}".format(filepath, e))
+                continue
+            self.add_tree(tree, filepath)
+
+    def add_tree(self, tree, path):
+        """Record the subtrees of a parsed file, reporting them with path"""
+        ids = self._ids
+        normalize_names = self.normalize != 'exact'
+        normalize_literals = self.normalize == 'literals'
+        done = {}  # id(node) -> (structure id, size)
+
+        # Iterative post-order walk, as deeply nested expressions could
+        # exceed the recursion limit.
+        stack = [(tree, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                for child in ast.iter_child_nodes(node):
+                    if not isinstance(child, ast.expr_context):
+                        stack.append((child, False))
+                continue
+
+            key = [type(node)]
+            size = 1
+            children = []
+            for field, value in ast.iter_fields(node):
+                if field in ('ctx', 'kind', 'type_comment'):
+                    continue
+                if isinstance(value, ast.AST):
+                    sid, child_size = done[id(value)]
+                    key.append(sid)
+                    size += child_size
+                    children.append((value, sid, child_size))
+                elif isinstance(value, list):
+                    items = []
+                    for item in value:
+                        if isinstance(item, ast.AST):
+                            sid, child_size = done[id(item)]
+                            items.append(sid)
+                            size += child_size
+                            children.append((item, sid, child_size))
+                        else:  # Plain names, e.g. global statement
+                            items.append(None if normalize_names else item)
+                    key.append(tuple(items))
+                elif normalize_names and field in _IDENTIFIER_FIELDS:
+                    key.append(None)
+                elif normalize_literals and isinstance(node, ast.Constant):
+                    key.append(type(value).__name__)
+                else:
+                    # 1, 1.0 and True are equal, with the same hash
+                    key.append((type(value), value))
+            key = tuple(key)
+            try:
+                sid = ids[key]
+            except KeyError:
+                sid = ids[key] = len(ids)
+            done[id(node)] = (sid, size)
+
+            for child, child_sid, child_size in children:
+                if child_size >= self.min_size:
+                    match = Match.from_node(path, child) \
+                        if hasattr(child, 'end_lineno') else None
+                    self._occurrences.setdefault(child_sid, []).append((match, sid))
+                    self._sizes[child_sid] = child_size
+
+    def groups(self):
+        """Get groups of duplicated code, largest first
+
+        :returns: A list of (size, matches) pairs, where size is the number of
+          nodes in each copy, and matches is a list of :class:`Match` records
+          for the copies.
+
+        Duplicates which are only part of a larger duplicated subtree (i.e.
+        every copy is inside a copy of the same larger structure) are left
+        out.
+        """
+        occurrences = self._occurrences
+
+        def enclosing_clone(sid):
+            """Is every copy of sid inside a copy of one larger clone?"""
+            while True:
+                parents = {parent for _, parent in occurrences[sid]}
+                if len(parents) != 1:
+                    return False
+                sid = parents.pop()
+                if len(occurrences.get(sid, ())) < 2:
+                    return False
+                # A parent without a position (e.g. ast.arguments) can't be
+                # reported itself, so look further up.
+                if sum(m is not None for m, _ in occurrences[sid]) >= 2:
+                    return True
+
+        groups = []
+        for sid, occs in occurrences.items():
+            matches = [m for m, _ in occs if m is not None]
+            if len(matches) < 2 or enclosing_clone(sid):
+                continue
+            matches.sort(key=lambda m: (m.path, m.lineno, m.col_offset))
+            groups.append((self._sizes[sid], matches))
+        groups.sort(key=lambda g: (-g[0], -len(g[1]), g[1][0].path,
+                                   g[1][0].lineno))
+        return groups
+
+def load_rules(file):
+    """Load named patterns from a JSON rules file.
+
+    The file should contain an object mapping rule names to pattern strings::
+
+        {
+          "shell-call": "subprocess.call(??, shell=True)",
+          "bare-except": "try: ??\\nexcept: ??"
+        }
+
+    :param file: Path to a rules file, or a readable file object
+    :returns: A dict of rule names to :class:`CompiledPattern` objects from
+      :func:`compile_pattern`, suitable for :class:`MultiPatternFinder`
+    """
+    import json
+    if isinstance(file, str):
+        with open(file, encoding='utf-8') as f:
+            rules = json.load(f)
+    else:
+        rules = json.load(file)
+    if not isinstance(rules, dict):
+        raise ValueError("Rules file should contain a JSON object")
+    for name, pattern in rules.items():
+        if not isinstance(pattern, str):
+            raise ValueError("Pattern for rule {!r} should be a string".format(name))
+    return {name: compile_pattern(pattern) for name, pattern in rules.items()}
+
+# Archive formats which iter_archive() can read
+ARCHIVE_SUFFIXES = ('.whl', '.zip', '.egg', '.tar', '.tar.gz', '.tgz',
+                    '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_SEPARATOR = '!'
+
+def is_archive(path):
+    """Check if a path has the file extension of an archive we can search"""
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+def iter_archive(path):
+    """Read the Python files in an archive, yielding (name, source) pairs
+
+    :param str path: Path to a wheel, zip or (optionally compressed) tar
+      archive, such as an sdist
+
+    Members are read into memory one at a time, without extracting the
+    archive. Each name is the archive path and the member path joined by
+    ``!``, e.g. ``requests-2.0-py3-none-any.whl!requests/api.py``, and each
+    source is bytes. Only members with a ``.py`` or ``.pyw`` extension are
+    included.
+    """
+    import posixpath
+    import tarfile
+    import zipfile
+
+    def name(member):
+        return path + ARCHIVE_SEPARATOR + member
+
+    if path.lower().endswith(('.whl', '.zip', '.egg')):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and info.filename.endswith(('.py', '.pyw')):
+                    yield name(info.filename), zf.read(info)
+    else:
+        # Stream mode reads compressed tarballs in one pass, without seeking
+        with tarfile.open(path, 'r|*') as tf:
+            for member in tf:
+                if member.isfile() and member.name.endswith(('.py', '.pyw')):
+                    # Drop the './' prefix from e.g. shutil.make_archive
+                    yield (name(posixpath.normpath(member.name)),
+                           tf.extractfile(member).read())
+
+def read_source(path):
+    """Read the source of a file, or of an archive member named as by
+    :func:`iter_archive`, as bytes.
+    """
+    archive, sep, _ = path.partition(ARCHIVE_SEPARATOR)
+    if sep and is_archive(archive) and not os.path.exists(path):
+        for name, data in iter_archive(archive):
+            if name == path:
+                return data
+        raise FileNotFoundError(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+class SourceBuffer(object):
+    """The raw bytes of a source file, with lines decoded on demand
+
+    :param str path: Path to the file, used to read it if *data* is not given
+    :param bytes data: The contents of the file, if they've already been read
+
+    Line offsets are found lazily, only as far into the file as the lines
+    requested, and only those lines are decoded. When pickled (e.g. to send
+    results from a worker process), a buffer with a path drops its data, and
+    reads the file again only if the lines are needed.
+    """
+    _newline = re.compile(rb'\r\n?|\n')
+
+    def __init__(self, path=None, data=None):
+        self.path = path
+        self._data = data
+        self._encoding = None
+        self._line_starts = [0]
+        self._scanned_to = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state.update(_data=None, _line_starts=[0], _scanned_to=0)
+        return state
+
+    @property
+    def data(self):
+        """The contents of the file, as bytes"""
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                self._data = f.read()
+        return self._data
+
+    @property
+    def encoding(self):
+        """The source encoding, from a coding cookie, BOM, or UTF-8"""
+        if self._encoding is None:
+            if isinstance(self.data, str):
+                self._encoding = 'utf-8'
+            else:
+                self._encoding = tokenize.detect_encoding(
+                    BytesIO(self.data).readline)[0]
+        return self._encoding
+
+    def _find_line_starts(self, lineno):
+        """Find the offsets where lines start, up to lineno"""
+        data, starts = self.data, self._line_starts
+        newline = self._newline
+        if isinstance(data, str):
+            newline = re.compile(newline.pattern.decode())
+        while len(starts) <= lineno and self._scanned_to < len(data):
+            m = newline.search(data, self._scanned_to)
+            if m is None:
+                self._scanned_to = len(data)
+                break
+            starts.append(m.end())
+            self._scanned_to = m.end()
+
+    def line(self, lineno):
+        """Get one line of the file (counting from 1), without the newline"""
+        self._find_line_starts(lineno)
+        starts = self._line_starts
+        if lineno > len(starts):
+            raise IndexError("Line {} out of range".format(lineno))
+        start = starts[lineno - 1]
+        end = starts[lineno] if lineno < len(starts) else len(self.data)
+        line = self.data[start:end]
+        if isinstance(line, bytes):
+            line = line.decode(self.encoding, 'replace')
+        if lineno == 1:
+            line = line.lstrip('\ufeff')
+        return line.rstrip('\r\n')
+
+class FileMatches(object):
+    """Matches found in one file by :meth:`ASTPatternFinder.iter_file_matches`
+
+    .. attribute:: path
+
+       The path of the file
+
+    .. attribute:: source
+
+       A :class:`SourceBuffer` with the file's contents
+
+    .. attribute:: matches
+
+       A list of the matching nodes, or of :class:`Match` records
+    """
+    __slots__ = ('path', 'source', 'matches', 'error', 'timings')
+
+    def __init__(self, path, source, matches, error=None, timings=None):
+        self.path = path
+        self.source = source
+        self.matches = matches
+        self.error = error
+        self.timings = timings
+
+class ScanHooks(object):
+    """Base class for callbacks on the progress of a search
+
+    Pass an instance as the *hooks* parameter of :class:`ASTPatternFinder`, and
+    override the methods for the events you're interested in. When searching
+    with several processes, the callbacks are made in the main process as each
+    file's results arrive, with timings measured in the worker.
+    """
+    def on_file_start(self, path):
+        """Called when a file is about to be scanned (or sent to a worker)"""
+
+    def on_parsed(self, path, read_time, parse_time):
+        """Called after a file is read & parsed
+
+        Times are in seconds. *parse_time* is None if the file was skipped
+        without parsing, because it can't match. When parsed files come from a
+        cache, *read_time* is 0, and reading is counted in *parse_time*.
+        """
+
+    def on_match(self, path, match):
+        """Called for each match found"""
+
+    def on_file_done(self, path, n_matches, match_time):
+        """Called after a file has been searched"""
+
+    def on_error(self, path, error):
+        """Called when a file can't be parsed, with the exception"""
+
+class ScanStats(ScanHooks):
+    """Collect statistics on a search, e.g. for the ``--stats`` option
+
+    :param int n_slowest: How many of the slowest files to remember
+
+    As well as the time for reading, parsing & matching files, which it gets
+    from the hooks, this keeps totals for other phases, such as walking
+    directories and printing output, recorded by :meth:`add_time` or
+    :meth:`timed`.
+    """
+    def __init__(self, n_slowest=10):
+        self.start = perf_counter()
+        self.n_slowest = n_slowest
+        self.times = {}
+        self.files = self.skipped = self.matches = 0
+        self.failures = []
+        self.slowest = []  # Heap of (time, path)
+
+    def add_time(self, phase, seconds):
+        """Add to the total time spent on a phase"""
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def timed(self, iterable, phase):
+        """Wrap an iterable, counting the time to get each item towards phase"""
+        it = iter(iterable)
+        while True:
+            t = perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_time(phase, perf_counter() - t)
+                return
+            self.add_time(phase, perf_counter() - t)
+            yield item
+
+    def timed_consumer(self, iterable, phase):
+        """Wrap an iterable, counting the time spent handling each item (the
+        time between yielding it and the next item being requested) towards
+        phase.
+        """
+        for item in iterable:
+            t = perf_counter()
+            yield item
+            self.add_time(phase, perf_counter() - t)
+
+    def on_parsed(self, path, read_time, parse_time):
+        self.files += 1
+        self.add_time('read', read_time)
+        if parse_time is None:
+            self.skipped += 1
+        else:
+            self.add_time('parse', parse_time)
+        self._file_time = read_time + (parse_time or 0)
+
+    def on_match(self, path, match):
+        self.matches += 1
+
+    def on_file_done(self, path, n_matches, match_time):
+        self.add_time('match', match_time)
+        self._add_slowest(self._file_time + match_time, path)
 
-            for filename in filenames:
-                if filename.endswith(('.py', '.pyw')):
-                    filepath = os.path.join(dirpath, filename)
+    def on_error(self, path, error):
+        self.files += 1
+        self.failures.append((path, error))
+
+    def _add_slowest(self, seconds, path):
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, (seconds, path))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, path))
+
+    def report(self, stream):
+        """Write a summary of the statistics to a text stream"""
+        elapsed = perf_counter() - self.start
+        stream.write("{} files searched in {:.3f}s ({:.0f} files/s)\n".format(
+            self.files, elapsed, self.files / elapsed if elapsed else 0))
+        stream.write("{} matches; {} files skipped without parsing; "
+                     "{} failed to parse\n".format(
+                        self.matches, self.skipped, len(self.failures)))
+        for phase in ['walk', 'read', 'parse', 'match', 'print']:
+            if phase in self.times:
+                stream.write("  {:<6} {:9.3f}s\n".format(phase, self.times[phase]))
+        if self.slowest:
+            stream.write("Slowest files:\n")
+            for seconds, path in sorted(self.slowest, reverse=True):
+                stream.write("  {:9.4f}s {}\n".format(seconds, path))
+        if self.failures:
+            stream.write("Parse failures:\n")
+            for path, error in self.failures:
+                stream.write("  {}: {}\n".format(path, error))
+
+def _announce_files(filepaths, hooks):
+    for filepath in filepaths:
+        hooks.on_file_start(_source_name(filepath))
+        yield filepath
+
+def _source_name(source):
+    """The path of a file to scan, or the name from a (name, data) pair"""
+    return source[0] if isinstance(source, tuple) else source
+
+def _call_hooks(hooks, result):
+    """Make hook calls for one file's results, from the recorded timings"""
+    path, times = result.path, result.timings
+    if result.error is not None:
+        hooks.on_error(path, result.error)
+        return
+    read_done = times.get('read', times['start'])
+    parse_done = times.get('parse')
+    hooks.on_parsed(path, read_done - times['start'],
+                    None if parse_done is None else parse_done - read_done)
+    for match in result.matches:
+        hooks.on_match(path, match)
+    match_time = 0.0 if parse_done is None else times['match'] - parse_done
+    hooks.on_file_done(path, len(result.matches), match_time)
+
+class Match(object):
+    """A compact record of one match, without a reference to the AST
+
+    Holding these rather than nodes means each file's AST can be freed as soon
+    as it has been searched. The attributes are ``path``, ``lineno``,
+    ``col_offset``, ``end_lineno``, ``end_col_offset``, ``type`` (the node type
+    name) and ``rule`` (the rule name, for :class:`MultiPatternFinder`, or
+    None).
+    """
+    __slots__ = ('path', 'lineno', 'col_offset', 'end_lineno',
+                 'end_col_offset', 'type', 'rule')
+
+    def __init__(self, path, lineno, col_offset, end_lineno, end_col_offset,
+                 type, rule=None):
+        self.path = path
+        self.lineno = lineno
+        self.col_offset = col_offset
+        self.end_lineno = end_lineno
+        self.end_col_offset = end_col_offset
+        self.type = type
+        self.rule = rule
+
+    @classmethod
+    def from_node(cls, path, node, rule=None):
+        """Make a record of a matching node"""
+        return cls(path, node.lineno, node.col_offset, node.end_lineno,
+                   node.end_col_offset, type(node).__name__, rule)
+
+    def __repr__(self):
+        return "<Match {} at {}:{}:{}>".format(self.type, self.path,
+                                               self.lineno, self.col_offset)
+
+    def as_dict(self):
+        """Describe the match as a dict of simple values, e.g. for JSON output
+
+        The keys are the attribute names, leaving out ``rule`` if it is None.
+        """
+        record = {
+            'path': self.path,
+            'lineno': self.lineno,
+            'col_offset': self.col_offset,
+            'end_lineno': self.end_lineno,
+            'end_col_offset': self.end_col_offset,
+            'type': self.type,
+        }
+        if self.rule is not None:
+            record['rule'] = self.rule
+        return record
+
+    def load_node(self, tree=None):
+        """Get the AST node for this match, by parsing the file again
+
+        :param ast.AST tree: The parsed file, if it's already available
+
+        Raises :exc:`LookupError` if the file has changed so that there's no
+        longer a matching node at the same position.
+        """
+        if tree is None:
+            tree = ast.parse(read_source(self.path))
+        position = (self.lineno, self.col_offset,
+                    self.end_lineno, self.end_col_offset)
+        for node in ast.walk(tree):
+            if type(node).__name__ == self.type and position == (
+                    getattr(node, 'lineno', None), getattr(node, 'col_offset', None),
+                    getattr(node, 'end_lineno', None),
+                    getattr(node, 'end_col_offset', None)):
+                return node
+        raise LookupError("No {} node at {}:{}:{}".format(
+            self.type, self.path, self.lineno, self.col_offset))
+
+class BufferedOutput(object):
+    """Collects text and writes it to a stream in large chunks
+
+    :param stream: A text stream, e.g. :data:`sys.stdout`
+    :param int bufsize: Approximate number of characters to collect before
+      writing
+    """
+    def __init__(self, stream, bufsize=1 << 16):
+        self.stream = stream
+        self.bufsize = bufsize
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.stream.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+        self.stream.flush()
+
+def _min_limit(a, b):
+    """The smaller of two limits, where None means no limit"""
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    return min(a, b)
+
+def _take(iterator, n):
+    return list(islice(iterator, n))
+
+def _chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+class _ContentGroups(object):
+    """Finds files with the same contents, so each is only searched once
+
+    Used by ASTPatternFinder.iter_file_matches(dedup=True). Files are read and
+    hashed in :meth:`unique`, and :meth:`expand` adds results for the copies
+    once the first file with the same content has been searched.
+    """
+    def __init__(self):
+        self.first = {}  # content hash -> name of the first file with it
+        # Results for the first files which have been searched; None if a file
+        # had no matches, so most sources aren't held in memory.
+        self.results = {}
+        self.copies = []  # (name, first name) of copies not yet reported
+
+    def unique(self, filepaths, keep_paths=False):
+        """Yield the first item with each content, as (name, source) pairs
+
+        If *keep_paths* is True, paths are yielded as they are, so they can be
+        loaded from a cache, at the cost of reading them twice if not cached.
+        """
+        for item in filepaths:
+            if isinstance(item, tuple):
+                name, data = item
+            else:
+                name = item
+                with open(item, 'rb') as f:
+                    data = f.read()
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if digest in self.first:
+                self.copies.append((name, self.first[digest]))
+                continue
+            self.first[digest] = name
+            yield item if keep_paths else (name, data)
+
+    def expand(self, results):
+        """Yield the results of searching unique files, each followed by
+        results for any copies of files searched so far
+        """
+        for result in results:
+            self.results[result.path] = \
+                result if (result.matches or result.error) else None
+            yield result
+            yield from self._copy_results()
+        # Every file has been searched by now
+        yield from self._copy_results()
+
+    def _copy_results(self):
+        ready = [c for c in self.copies if c[1] in self.results]
+        if not ready:
+            return
+        self.copies = [c for c in self.copies if c[1] not in self.results]
+        for name, first in ready:
+            result = self.results[first]
+            # Copies weren't parsed, so the hooks just see when they finished
+            times = {'start': perf_counter()}
+            if result is None:
+                yield FileMatches(name, None, [], timings=times)
+                continue
+            matches = result.matches
+            if matches and isinstance(matches[0], Match):
+                matches = [Match(name, m.lineno, m.col_offset, m.end_lineno,
+                                 m.end_col_offset, m.type, m.rule)
+                           for m in matches]
+            yield FileMatches(name, result.source, list(matches), result.error,
+                              times)
+
+# State for worker processes used by ASTPatternFinder.scan_files(jobs=N)
+_worker_finder = None
+
+def _init_worker(finder):
+    global _worker_finder
+    _worker_finder = finder
+
+def _scan_in_worker(filepaths, limit, timed, records):
+    return [_worker_finder._scan_path(p, limit, timed, records)
+            for p in filepaths]
+
+def default_cache_dir():
+    """The directory used by :class:`ASTCache` if none is specified
+
+    This follows the XDG convention: ``$XDG_CACHE_HOME/astsearch``, falling
+    back to ``~/.cache/astsearch``.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'astsearch')
+
+class ASTCache(object):
+    """Persistent on-disk cache of parsed ASTs
+
+    :param str directory: Where to store cache entries; defaults to
+      :func:`default_cache_dir`
+    :param int max_size: Approximate limit on the total size of the cache in
+      bytes. When it is exceeded, the least recently used entries are removed.
+
+    Each file's AST is stored pickled, along with the file's modification
+    time, size, a hash of its contents and the identifiers in it. An entry is
+    used directly if the stat fields match. If they don't, the file is read and
+    hashed, so that touching a file without changing it doesn't force it to be
+    parsed again.
+
+    The identifiers let :meth:`parse` skip files which can't match a pattern
+    without loading their ASTs. Entries aren't compressed: decompressing
+    them would take about as long as parsing the file again.
+    """
+    # mtime, size, content hash, length of the identifiers
+    _header = struct.Struct('<qq16sI')
+    _identifier = re.compile(rb'[A-Za-z_][A-Za-z0-9_]*')
+    # Only mark entries as recently used this often, so hits don't write
+    _touch_interval = 3600
+
+    def __init__(self, directory=None, max_size=512 * 2**20):
+        if directory is None:
+            directory = default_cache_dir()
+        # ASTs differ between Python versions, so each gets its own entries
+        self.directory = os.path.join(directory, sys.implementation.cache_tag)
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._size = None
+
+    def _entry_path(self, filepath):
+        key = os.path.abspath(filepath).encode('utf-8', 'surrogateescape')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    @classmethod
+    def _names(cls, data):
+        """The identifiers in source code, one per line, for may_match checks"""
+        return b'\n' + b'\n'.join(set(cls._identifier.findall(data))) + b'\n'
+
+    def parse(self, filepath, may_match=None):
+        """Get the AST for a Python file, from the cache if possible
+
+        :param str filepath: The file to parse
+        :param may_match: A function, such as
+          :meth:`ASTPatternFinder.may_match`, which is passed the identifiers
+          in the file as bytes. If it returns False, the file is skipped.
+
+        Returns None if the file was skipped; its AST isn't loaded or parsed.
+        Raises :exc:`SyntaxError` if the file needs parsing and is not valid;
+        failed parses are not cached.
+        """
+        st = os.stat(filepath)
+        entry_path = self._entry_path(filepath)
+        cached = None
+        try:
+            with open(entry_path, 'rb') as f:
+                header = f.read(self._header.size)
+                mtime_ns, size, digest, names_len = self._header.unpack(header)
+                names = f.read(names_len)
+                fresh = (mtime_ns, size) == (st.st_mtime_ns, st.st_size)
+                if fresh and may_match is not None and not may_match(names):
+                    self.hits += 1
+                    self._touch(f, entry_path)
+                    return None
+                payload = f.read()
+                if fresh and payload:
+                    tree = pickle.loads(payload)
+                    self.hits += 1
+                    self._touch(f, entry_path)
+                    return tree
+                # Stale, or the file was skipped before so it has no AST
+                cached = digest, names, payload
+        except (OSError, struct.error, pickle.UnpicklingError, EOFError):
+            cached = None
+
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        reused = cached is not None and cached[0] == digest
+        if reused:
+            # Contents unchanged; only the stat fields need updating
+            names, payload = cached[1:]
+        else:
+            names, payload = self._names(data), b''
+
+        if may_match is not None and not may_match(names):
+            # The AST, if we don't have it, is parsed when a pattern needs it
+            tree = None
+        elif payload:
+            tree = pickle.loads(payload)
+        else:
+            tree = ast.parse(data)
+            payload = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+            reused = False
+        if reused:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._store(entry_path, self._header.pack(
+            st.st_mtime_ns, st.st_size, digest, len(names)) + names + payload)
+        return tree
+
+    def _touch(self, f, entry_path):
+        """Mark an entry as recently used, if it hasn't been lately"""
+        try:
+            if os.fstat(f.fileno()).st_mtime < time() - self._touch_interval:
+                os.utime(entry_path)
+        except OSError:
+            pass
+
+    def _store(self, entry_path, blob):
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Write to a temporary file & rename, so that concurrent readers
+        # (e.g. worker processes) never see a partial entry.
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, entry_path)
+
+        if self._size is None:
+            self._size = sum(s for _, s, _ in self._entries())
+        else:
+            self._size += len(blob)
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        """Yield (mtime, size, path) for each entry in the cache"""
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed by another process
+                yield st.st_mtime, st.st_size, entry.path
+
+    def evict(self, target_size=None):
+        """Remove least recently used entries until the cache fits in
+        *target_size* bytes (default: 90% of *max_size*).
+        """
+        if target_size is None:
+            target_size = int(self.max_size * 0.9)
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+class MemoryASTCache(object):
+    """Cache of parsed ASTs held in memory, for long-running processes
+
+    A file is parsed again if its modification time or size has changed.
+    Failures to parse are remembered as well, and raised again on later
+    requests for the same unchanged file.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = self.misses = 0
+
+    def parse(self, filepath, may_match=None):
+        """Get the AST for a Python file, parsing it only if it has changed
+
+        *may_match* is as for :meth:`ASTCache.parse`: if given, it's checked
+        against the identifiers in the file, and None is returned if it
+        can't match.
+        """
+        st = os.stat(filepath)
+        entry = self.entries.get(filepath)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            self.hits += 1
+            names, result = entry[2:]
+        else:
+            self.misses += 1
+            with open(filepath, 'rb') as f:
+                source = f.read()
+            names = ASTCache._names(source)
+            try:
+                result = ast.parse(source)
+            except SyntaxError as e:
+                result = e
+            self.entries[filepath] = (st.st_mtime_ns, st.st_size, names, result)
+
+        if may_match is not None and not may_match(names):
+            return None
+        if isinstance(result, SyntaxError):
+            raise result
+        return result
+
+    def retain(self, filepaths):
+        """Drop entries for any files not in filepaths, e.g. deleted files"""
+        keep = set(filepaths)
+        for filepath in list(self.entries):
+            if filepath not in keep:
+                del self.entries[filepath]
+
+# Longer string constants aren't indexed, to keep the index small
+_INDEX_MAX_STRING = 80
+
+def index_terms(tree):
+    """Collect the terms recorded for a parsed file in an :class:`ASTIndex`
+
+    Terms are identifiers (names, attributes, arguments, keywords and import
+    targets, with dotted names split into parts), node types as ``t:Call``,
+    and short string constants as ``s:value``.
+    """
+    terms = set()
+    for node in ast.walk(tree):
+        terms.add('t:' + type(node).__name__)
+        for field, value in ast.iter_fields(node):
+            if field in _IDENTIFIER_FIELDS and isinstance(value, str):
+                terms.update(value.split('.'))
+            elif field == 'names' and isinstance(value, list) \
+                    and all(isinstance(n, str) for n in value):
+                terms.update(value)  # e.g. global statement
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) \
+                and len(node.value) <= _INDEX_MAX_STRING:
+            terms.add('s:' + node.value)
+    # Interned, so each term is stored once in the pickled index
+    return frozenset(sys.intern(t) for t in terms)
+
+def pattern_index_terms(pattern):
+    """The terms which a file must contain to match pattern; see
+    :func:`index_terms`.
+
+    These are the names from :func:`pattern_literals`, the node type of the
+    pattern's root, and short string constants in the pattern.
+    """
+    terms = set(pattern_literals(pattern))
+    if isinstance(pattern, ast.AST):
+        terms.add('t:' + type(pattern).__name__)
+
+    def collect_strings(p):
+        if isinstance(p, ast.Constant):
+            if isinstance(p.value, str) and len(p.value) <= _INDEX_MAX_STRING:
+                terms.add('s:' + p.value)
+        elif isinstance(p, ast.AST):
+            for _, value in ast.iter_fields(p):
+                collect_strings(value)
+        elif isinstance(p, list):
+            for item in p:
+                collect_strings(item)
+        elif isinstance(p, KeywordsChecker):
+            collect_strings(p.template_keywords)
+        # Other checkers may not require their contents to match exactly
+
+    collect_strings(pattern)
+    return terms
+
+class ASTIndex(object):
+    """On-disk index of the terms used in each file in a directory
+
+    :param str directory: The directory to index
+    :param str path: Where to store the index; by default, a file under
+      :func:`default_cache_dir` named after the directory
+
+    The index maps terms (see :func:`index_terms`) to the files containing
+    them, so a search can skip files which can't match without opening them.
+    It records each file's modification time and size: a file which has
+    changed since it was indexed is always searched. Use :meth:`update` to
+    bring the index up to date, and :meth:`save` to store it.
+    """
+    _version = 1
+
+    def __init__(self, directory, path=None):
+        self.directory = os.path.abspath(directory)
+        if path is None:
+            digest = hashlib.sha1(self.directory.encode('utf-8', 'surrogateescape'))
+            path = os.path.join(default_cache_dir(), sys.implementation.cache_tag,
+                                'index-' + digest.hexdigest()[:16])
+        self.path = path
+        # relpath -> (mtime_ns, size, terms), with terms None if parsing failed
+        self.files = {}
+        self.postings = {}  # term -> set of relpaths
+
+    def load(self):
+        """Load the index from disk, returning False if there is none
+
+        An index for a different directory or version is ignored.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return False
+        if data.get('version') != self._version \
+                or data.get('directory') != self.directory:
+            return False
+        self.files = data['files']
+        self.postings = data['postings']
+        return True
+
+    def save(self):
+        """Write the index to disk, replacing any previous version atomically"""
+        blob = zlib.compress(pickle.dumps({
+            'version': self._version, 'directory': self.directory,
+            'files': self.files, 'postings': self.postings,
+        }, pickle.HIGHEST_PROTOCOL), 1)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, self.path)
+
+    def _relpath(self, filepath):
+        return os.path.relpath(os.path.abspath(filepath), self.directory)
+
+    def update(self, filepaths):
+        """Index new & changed files, and drop files which are no longer listed
+
+        :param filepaths: All the files to include, e.g. from
+          :meth:`ASTPatternFinder.iter_files`
+        :returns: (number of files indexed, number of files removed)
+        """
+        old_files = self.files
+        self.files = {}
+        changed = 0
+        for filepath in filepaths:
+            relpath = sys.intern(self._relpath(filepath))
+            try:
+                st = os.stat(filepath)
+                entry = old_files.get(relpath)
+                if entry is None or entry[:2] != (st.st_mtime_ns, st.st_size):
+                    with open(filepath, 'rb') as f:
+                        data = f.read()
                     try:
-                        for match in self.scan_file(filepath):
-                            yield filepath, match
-                    except SyntaxError as e:
-                        warnings.warn("Failed to parse {}:\n{}".format(filepath, e))
+                        terms = index_terms(ast.parse(data))
+                    except (SyntaxError, ValueError):
+                        terms = None
+                    entry = (st.st_mtime_ns, st.st_size, terms)
+                    changed += 1
+            except OSError:
+                continue
+            self.files[relpath] = entry
+        removed = len(old_files.keys() - self.files.keys())
+
+        if changed or removed:
+            self.postings = postings = {}
+            for relpath, (_, _, terms) in self.files.items():
+                for term in (terms or ()):
+                    try:
+                        postings[term].add(relpath)
+                    except KeyError:
+                        postings[term] = {relpath}
+        return changed, removed
+
+    def candidates(self, terms):
+        """The indexed files containing all of terms, as a set of relative
+        paths, or None if terms is empty (so any file could match).
+        """
+        if not terms:
+            return None
+        postings = sorted((self.postings.get(t, set()) for t in terms), key=len)
+        result = set(postings[0])
+        for p in postings[1:]:
+            if not result:
+                break
+            result &= p
+        return result
+
+    def filter(self, filepaths, candidates):
+        """Yield the files which need searching, given a set of candidates
+
+        Files are skipped only if they are in the index, unchanged since they
+        were indexed, and not candidates. So files which are new, changed, or
+        failed to parse are always yielded.
+        """
+        for filepath in filepaths:
+            relpath = self._relpath(filepath)
+            entry = self.files.get(relpath)
+            if entry is None or entry[2] is None or relpath in candidates:
+                yield filepath
+                continue
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            if (st.st_mtime_ns, st.st_size) != entry[:2]:
+                yield filepath
+
+class QueryServer(object):
+    """Answer search queries for one directory, keeping parsed files in memory
+
+    :param str root: The directory to search
+
+    Requests and responses are JSON objects, one per line. A search request
+    looks like ``{"id": 1, "pattern": "?/?"}``, and may also have
+    ``max_count`` and ``max_depth`` keys. The response has a list of
+    ``matches``, each as described by :meth:`Match.as_dict`.
+    ``{"cmd": "stats"}`` asks for statistics on the cache. Any ``id`` in a
+    request is copied to the response, and errors are reported with an
+    ``error`` key.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.cache = MemoryASTCache()
+        self.queries = 0
+
+    def search(self, pattern, max_count=None, max_depth=None):
+        """Run one query, returning a list of match dicts"""
+        patternfinder = ASTPatternFinder(compile_pattern(pattern),
+                                         cache=self.cache, max_depth=max_depth)
+        filepaths = list(patternfinder.iter_files(self.root))
+        self.cache.retain(filepaths)
+        self.queries += 1
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Parse failures
+            return [match.as_dict() for match in patternfinder.scan_files(
+                        filepaths, max_count=max_count, records=True)]
+
+    def stats(self):
+        """Statistics on the queries answered and the cached files"""
+        lookups = self.cache.hits + self.cache.misses
+        stats = {
+            'queries': self.queries,
+            'files': len(self.cache.entries),
+            'source_bytes': sum(e[1] for e in self.cache.entries.values()),
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_hit_rate': (self.cache.hits / lookups) if lookups else None,
+        }
+        try:
+            import resource
+        except ImportError:  # Not on Windows
+            pass
+        else:
+            # Peak memory use; Linux reports this in kilobytes
+            stats['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return stats
+
+    def handle(self, request):
+        """Answer one request, given & returned as a dict
+
+        Invalid requests, and any error while answering one, give a response
+        with an ``error`` key, so one bad query can't stop the server.
+        """
+        if not isinstance(request, dict):
+            return {'error': "Request must be a JSON object"}
+        response = {}
+        if 'id' in request:
+            response['id'] = request['id']
+        try:
+            cmd = request.get('cmd', 'search')
+            if cmd == 'search':
+                response['matches'] = self.search(**self._search_args(request))
+            elif cmd == 'stats':
+                response['stats'] = self.stats()
+            else:
+                response['error'] = "Unknown command: {!r}".format(cmd)
+        except Exception as e:
+            response['error'] = "{}: {}".format(type(e).__name__, e)
+        return response
+
+    @staticmethod
+    def _search_args(request):
+        """Check the fields of a search request, returning kwargs for search"""
+        pattern = request.get('pattern')
+        if not isinstance(pattern, str) or not pattern.strip():
+            raise ValueError("'pattern' must be a non-empty string")
+        kwargs = {'pattern': pattern}
+        for key in ('max_count', 'max_depth'):
+            value = request.get(key)
+            if value is not None and (type(value) is not int or value < 0):
+                raise ValueError("{!r} must be a non-negative integer".format(key))
+            kwargs[key] = value
+        return kwargs
+
+    def serve_stream(self, infile, outfile):
+        """Answer requests from a binary file object until it is closed"""
+        import json
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': "Invalid JSON: {}".format(e)}
+            else:
+                response = self.handle(request)
+            outfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            outfile.flush()
+
+    def serve_unix(self, socket_path):
+        """Listen for connections on a Unix socket, answering one at a time"""
+        import socketserver
+        query_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                query_server.serve_stream(self.rfile, self.wfile)
+
+        with socketserver.UnixStreamServer(socket_path, Handler) as server:
+            try:
+                server.serve_forever()
+            finally:
+                os.unlink(socket_path)
 
 def must_exist_checker(node, path):
     """Checker function to ensure a field is not empty"""
@@ -141,6 +2451,161 @@ class ArgsDefChecker:
         if self.kwarg:
             assert_ast_like(sample_node.kwarg, self.kwarg)
 
+class KeywordsChecker:
+    """Checks the keyword arguments of a call against pattern keywords.
+
+    This is used when a pattern allows other keyword arguments, e.g.
+    ``f(a=1, ??=??)``, so the template keywords may be found in any order.
+    """
+    def __init__(self, template_keywords):
+        self.template_keywords = template_keywords
+
+    def __repr__(self):
+        return "astsearch.KeywordsChecker({})".format(
+            ', '.join(k.arg for k in self.template_keywords))
+
+    def __call__(self, sample_keywords, path):
+        sample_kwargs = {k.arg: k.value for k in sample_keywords}
+
+        for k in self.template_keywords:
+            if k.arg in sample_kwargs:
+                astcheck.assert_ast_like(sample_kwargs[k.arg], k.value,
+                                         path + [k.arg])
+            else:
+                raise astcheck.ASTMismatch(path, '(missing)',
+                                           'keyword arg %s' % k.arg)
+
+class _MatcherCompiler(object):
+    """Generates Python source for a function checking nodes against a pattern
+
+    The generated code mirrors :func:`astcheck.assert_ast_like`, but returns
+    False at the first difference instead of raising an exception.
+    """
+    def __init__(self):
+        self.lines = []
+        self.namespace = {'ASTMismatch': astcheck.ASTMismatch}
+        self.nvars = 0
+
+    def emit(self, line, indent):
+        self.lines.append('    ' * indent + line)
+
+    def const(self, value):
+        name = 'c%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def new_var(self):
+        self.nvars += 1
+        return 'n%d' % self.nvars
+
+    def compile(self, pattern):
+        self.node('n0', pattern, 1)
+        self.emit('return True', 1)
+        source = '\n'.join(['def match(n0):'] + self.lines) + '\n'
+        exec(compile(source, '<astsearch matcher>', 'exec'), self.namespace)
+        matcher = self.namespace['match']
+        matcher.source = source
+        return matcher
+
+    def node(self, var, template, indent):
+        if callable(template):
+            self.checker(var, template, indent)
+            return
+        elif not isinstance(template, ast.AST):
+            # Not a valid template, but leave the details to astcheck
+            self.generic(var, template, indent)
+            return
+
+        self.emit('if not isinstance({}, {}): return False'.format(
+            var, self.const(type(template))), indent)
+        for name, template_field in ast.iter_fields(template):
+            if template_field is None:
+                continue  # Unspecified field
+            field_var = self.new_var()
+            self.emit('{} = {}.{}'.format(field_var, var, name), indent)
+            if isinstance(template_field, list):
+                if template_field and (isinstance(template_field[0], ast.AST)
+                                       or callable(template_field[0])):
+                    self.node_list(field_var, template_field, indent)
+                else:
+                    # List of plain values, e.g. 'global' statement names
+                    self.emit('if {} != {}: return False'.format(
+                        field_var, self.const(template_field)), indent)
+            elif isinstance(template_field, ast.AST) or callable(template_field):
+                self.node(field_var, template_field, indent)
+            else:
+                # Single value, e.g. Name.id
+                self.emit('if {} != {}: return False'.format(
+                    field_var, self.const(template_field)), indent)
+
+    def node_list(self, var, template, indent, start=None):
+        """Check a list of nodes; start is for a slice of a listmiddle"""
+        if start is None:
+            self.emit('if len({}) != {}: return False'.format(var, len(template)),
+                      indent)
+            start = 0
+        for i, template_node in enumerate(template, start=start):
+            item_var = self.new_var()
+            self.emit('{} = {}[{}]'.format(item_var, var, i), indent)
+            self.node(item_var, template_node, indent)
+
+    def checker(self, var, checker, indent):
+        if checker in (must_exist_checker, astcheck.must_exist):
+            self.emit('if {0} is None or {0} == []: return False'.format(var),
+                      indent)
+        elif checker in (must_not_exist_checker, astcheck.must_not_exist):
+            self.emit('if {0} is not None and {0} != []: return False'.format(var),
+                      indent)
+        elif isinstance(checker, astcheck.name_or_attr):
+            name = self.const(checker.name)
+            self.emit('if isinstance({}, {}):'.format(var, self.const(ast.Name)),
+                      indent)
+            self.emit('if {}.id != {}: return False'.format(var, name), indent + 1)
+            self.emit('elif isinstance({}, {}):'.format(var, self.const(ast.Attribute)),
+                      indent)
+            self.emit('if {}.attr != {}: return False'.format(var, name), indent + 1)
+            self.emit('else: return False', indent)
+        elif isinstance(checker, KeywordsChecker):
+            kwargs_var = self.new_var()
+            self.emit('{} = {{k.arg: k.value for k in {}}}'.format(kwargs_var, var),
+                      indent)
+            for k in checker.template_keywords:
+                value_var = self.new_var()
+                self.emit('{} = {}.get({})'.format(value_var, kwargs_var,
+                                                   self.const(k.arg)), indent)
+                self.emit('if {} is None: return False'.format(value_var), indent)
+                self.node(value_var, k.value, indent)
+        elif isinstance(checker, astcheck.listmiddle):
+            self.emit('if not isinstance({}, list): return False'.format(var), indent)
+            for part, start in [(checker.front, 0), (checker.back, -len(checker.back))]:
+                if part:
+                    self.emit('if len({}) < {}: return False'.format(var, len(part)),
+                              indent)
+                    self.node_list(var, part, indent, start=start)
+        else:
+            self.generic(var, checker, indent)
+
+    def generic(self, var, template, indent):
+        """Fall back to astcheck for checkers we don't know how to inline"""
+        self.emit('try:', indent)
+        self.emit('{}({}, {}, [])'.format(self.const(assert_ast_like), var,
+                                          self.const(template)), indent + 1)
+        self.emit('except ASTMismatch:', indent)
+        self.emit('return False', indent + 1)
+
+def compile_matcher(pattern):
+    """Compile a pattern into a function checking if a node matches it.
+
+    The function takes an AST node and returns True or False, with the same
+    results as :func:`astcheck.is_ast_like`. But it checks the fields of the
+    node with straight-line generated code, rather than walking the pattern
+    and raising an exception at the first difference. Checkers which it can't
+    translate, such as :class:`ArgsDefChecker`, are still called normally.
+
+    :param ast.AST pattern: A pattern, e.g. from :func:`prepare_pattern`
+    """
+    return _MatcherCompiler().compile(pattern)
+
 WILDCARD_NAME = "__astsearch_wildcard"
 MULTIWILDCARD_NAME = "__astsearch_multiwildcard"
 
@@ -196,7 +2661,7 @@ class TemplatePruner(ast.NodeTransformer):
         self.prune_wildcard_body(node, 'body')
         return self.generic_visit(node)
 
-    visit_ClassDef = visit_FunctionDef
+    visit_ClassDef = visit_AsyncFunctionDef = visit_FunctionDef
 
     def visit_arguments(self, node):
         positional_final_wildcard = False
@@ -257,7 +2722,7 @@ class TemplatePruner(ast.NodeTransformer):
         return self.generic_visit(node)
 
     # All of these have body & orelse node lists
-    visit_For = visit_While = visit_If
+    visit_For = visit_AsyncFor = visit_While = visit_If
 
     def visit_Try(self, node):
         self.prune_wildcard_body(node, 'body')
@@ -278,6 +2743,8 @@ class TemplatePruner(ast.NodeTransformer):
         self.prune_wildcard_body(node, 'body')
         return self.generic_visit(node)
 
+    visit_AsyncWith = visit_With
+
     def visit_Call(self, node):
         kwargs_are_subset = False
         for i, n in enumerate(node.args):
@@ -297,22 +2764,8 @@ class TemplatePruner(ast.NodeTransformer):
                         k.arg == MULTIWILDCARD_NAME for k in node.keywords):
             template_keywords = [self.visit(k) for k in node.keywords
                                  if k.arg != MULTIWILDCARD_NAME]
-
-            def kwargs_checker(sample_keywords, path):
-                sample_kwargs = {k.arg: k.value for k in sample_keywords}
-
-                for k in template_keywords:
-                    if k.arg == MULTIWILDCARD_NAME:
-                        continue
-                    if k.arg in sample_kwargs:
-                        astcheck.assert_ast_like(sample_kwargs[k.arg], k.value,
-                                                 path + [k.arg])
-                    else:
-                        raise astcheck.ASTMismatch(path, '(missing)',
-                                                   'keyword arg %s' % k.arg)
-
             if template_keywords:
-                node.keywords = kwargs_checker
+                node.keywords = KeywordsChecker(template_keywords)
             else:
                 # Shortcut if there are no keywords to check
                 del node.keywords
@@ -380,6 +2833,65 @@ class TemplatePruner(ast.NodeTransformer):
     def _visit_list(self, l):
         return [self.visit(n) for n in l]
 
+# Fields holding identifiers, which must be spelled out in matching code
+_IDENTIFIER_FIELDS = frozenset({'id', 'attr', 'name', 'arg', 'module', 'asname', 'names'})
+
+def pattern_literals(pattern):
+    """Find the names which must appear in the source of any match for pattern
+
+    These are identifiers such as variable, attribute, function & keyword
+    argument names. Dotted names from imports are split into their parts.
+    Non-ASCII names are left out, because Python normalises identifiers, so
+    the source may spell them differently. So are string & number constants,
+    as the same value can be written in many ways.
+
+    :param ast.AST pattern: A pattern, e.g. from :func:`prepare_pattern`
+    :returns: A set of strings
+    """
+    literals = set()
+
+    def add(name):
+        for part in name.split('.'):
+            if part.isascii() and part.isidentifier() \
+                    and not part.startswith(WILDCARD_NAME):
+                literals.add(part)
+
+    def collect(p):
+        if isinstance(p, ast.AST):
+            for field, value in ast.iter_fields(p):
+                if field in _IDENTIFIER_FIELDS and isinstance(value, str):
+                    add(value)
+                elif field == 'names' and isinstance(value, list) \
+                        and all(isinstance(n, str) for n in value):
+                    for name in value:  # e.g. global statement
+                        add(name)
+                else:
+                    collect(value)
+        elif isinstance(p, list):
+            for item in p:
+                collect(item)
+        elif isinstance(p, astcheck.name_or_attr):
+            add(p.name)
+        elif isinstance(p, astcheck.listmiddle):
+            collect(p.front)
+            collect(p.back)
+        elif isinstance(p, ArgsDefChecker):
+            collect(p.args)
+            for argname, dflt in p.defaults:
+                add(argname)
+                collect(dflt)
+            collect([p.vararg, p.kwarg])
+            for arg, dflt in p.kwonly_args_dflts:
+                collect([arg, dflt])
+        elif isinstance(p, KeywordsChecker):
+            for k in p.template_keywords:
+                collect(k)
+        # Other checker functions could accept anything, so we can't require
+        # any names from them.
+
+    collect(pattern)
+    return literals
+
 def prepare_pattern(s):
     """Turn a string pattern into an AST pattern
 
@@ -399,17 +2911,69 @@ def prepare_pattern(s):
         del pattern.ctx
     return TemplatePruner().visit(pattern)
 
+class CompiledPattern(object):
+    """A prepared pattern, with its matcher function and literal names
+
+    :param ast.AST pattern: A pattern, e.g. from :func:`prepare_pattern`
+    :param str text: The pattern string it came from, if known
+
+    Unlike the generated matcher function, this can be pickled, e.g. to send
+    it to another process. When the text is known, only that is pickled, and
+    the pattern is prepared again (using :func:`compile_pattern`'s cache) when
+    it's loaded. The pattern should not be modified once it's compiled.
+    """
+    def __init__(self, pattern, text=None):
+        self.pattern = pattern
+        self.text = text
+        self.matcher = compile_matcher(pattern)
+        self.literals = frozenset(pattern_literals(pattern))
+
+    def __repr__(self):
+        if self.text is not None:
+            return "astsearch.CompiledPattern.from_text({!r})".format(self.text)
+        return "astsearch.CompiledPattern({})".format(ast.dump(self.pattern))
+
+    def __reduce__(self):
+        if self.text is not None:
+            return compile_pattern, (self.text,)
+        return CompiledPattern, (self.pattern,)
+
+    @classmethod
+    def from_text(cls, text):
+        """Prepare & compile a string pattern, without caching it"""
+        return cls(prepare_pattern(text), text)
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(text):
+    """Prepare & compile a string pattern, returning a :class:`CompiledPattern`
+
+    Results are cached for the most recently used patterns, so repeating a
+    query doesn't parse & prepare the pattern again. The same object is
+    returned for the same text, so it should be treated as read-only.
+    """
+    return CompiledPattern.from_text(text)
+
 def main(argv=None):
     """Run astsearch from the command line.
 
     :param list argv: Command line arguments; defaults to :data:`sys.argv`
     """
     import argparse
+    if argv is None:
+        argv = sys.argv[1:]
+
     ap = argparse.ArgumentParser()
-    ap.add_argument('pattern',
+    ap.add_argument('pattern', nargs='?',
                     help="AST pattern to search for; see docs for examples")
-    ap.add_argument('path', nargs='?', default='.',
-                    help="file or directory to search in")
+    ap.add_argument('paths', nargs='*', metavar='path',
+                    help="files, directories or archives (wheel, zip or "
+                         "tarball) to search in (default: .)")
+    ap.add_argument('--files-from', metavar='FILE',
+                    help="also search the paths listed in FILE, one per line "
+                         "('-' reads them from stdin as they arrive)")
+    ap.add_argument('-0', '--null', action='store_true',
+                    help="paths in --files-from are separated by NUL "
+                         "characters, not newlines")
     if sys.version_info >= (3, 8):
         ap.add_argument(
             '-m', '--max-lines', type=int, default=10,
@@ -418,65 +2982,425 @@ def main(argv=None):
     ap.add_argument('-l', '--files-with-matches', action='store_true',
                     help="output only the paths of matching files, not the "
                          "lines that matched")
+    ap.add_argument('-c', '--count', action='store_true',
+                    help="output only the number of matches in each matching "
+                         "file")
+    ap.add_argument('--max-count', type=_non_negative_int, metavar='N',
+                    help="stop searching after N matches")
+    ap.add_argument('--format', choices=['text', 'jsonl', 'null'], default='text',
+                    help="output format: 'text' for people, 'jsonl' for one "
+                         "JSON object per match, or 'null' for NUL-separated "
+                         "paths of matching files")
+    ap.add_argument('--snippets', action='store_true',
+                    help="with --format jsonl, include the source lines of "
+                         "each match")
+    ap.add_argument('-j', '--jobs', type=_non_negative_int, default=1,
+                    help="number of processes to scan files in parallel (0 "
+                         "uses one per CPU); match order between files is "
+                         "then not fixed")
+    ap.add_argument('--git', action='store_true',
+                    help="search the files git knows about (tracked, or "
+                         "untracked but not ignored), instead of walking "
+                         "the directory")
+    ap.add_argument('--rev', metavar='RANGE',
+                    help="search the files in a range of git commits, e.g. "
+                         "v1.0..main, parsing each distinct file version once")
+    ap.add_argument('--gitignore', action='store_true',
+                    help="skip files matched by .gitignore files while "
+                         "walking the directory")
+    ap.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                    help="skip files and directories matching GLOB (may be "
+                         "repeated)")
+    ap.add_argument('--include', action='append', default=[], metavar='GLOB',
+                    help="only search files matching GLOB (may be repeated)")
+    ap.add_argument('--include-venvs', action='store_true',
+                    help="search inside virtualenvs (directories containing "
+                         "pyvenv.cfg), which are skipped by default")
+    ap.add_argument('--shard', type=_parse_shard, metavar='I/N',
+                    help="only search the I-th of N disjoint sets of files "
+                         "(from 1/N to N/N), to split a search between "
+                         "machines; combine the jsonl output with --merge")
+    ap.add_argument('--shard-by-size', action='store_true',
+                    help="with --shard, balance shards by the size of the "
+                         "files, rather than by hashing their paths")
+    ap.add_argument('--dedup', action='store_true',
+                    help="parse and search files with identical contents "
+                         "only once, showing the matches for each copy")
+    ap.add_argument('--cache', action='store_true',
+                    help="cache parsed files between runs, in {}".format(
+                        default_cache_dir()))
+    ap.add_argument('--cache-dir', metavar='DIR',
+                    help="cache parsed files in DIR (implies --cache)")
+    ap.add_argument('--index', action='store_true',
+                    help="skip files which can't match according to the "
+                         "index made by --build-index")
+    ap.add_argument('--index-file', metavar='FILE',
+                    help="use the index in FILE (implies --index), or store "
+                         "it there with --build-index")
+    ap.add_argument('--build-index', action='store_true',
+                    help="instead of searching, record the names, node types "
+                         "and strings in each file of the directory, so "
+                         "searches with --index can skip files")
+    ap.add_argument('--update-index', action='store_true',
+                    help="like --build-index, but only read files changed "
+                         "since the index was last updated")
+    ap.add_argument('--max-depth', type=int, metavar='N',
+                    help="only search statements nested up to N levels deep "
+                         "(0 is module level, 1 includes the bodies of "
+                         "top-level classes and functions)")
+    ap.add_argument('--within', metavar='PATTERN',
+                    help="only search inside code matching PATTERN, e.g. "
+                         "'async def ?(??): ??'")
+    ap.add_argument('--rules', metavar='FILE',
+                    help="search for all the named patterns in a JSON rules "
+                         "file instead of a single pattern")
+    ap.add_argument('--duplicates', action='store_true',
+                    help="instead of searching for a pattern, find groups of "
+                         "structurally identical code")
+    ap.add_argument('--min-size', type=int, default=20, metavar='N',
+                    help="with --duplicates, the smallest duplicated code to "
+                         "report, in AST nodes (default 20)")
+    ap.add_argument('--normalize', choices=NORMALIZE_LEVELS, default='names',
+                    help="with --duplicates, 'names' (default) ignores "
+                         "differences in names, 'literals' also ignores "
+                         "constant values, 'exact' ignores neither")
+    ap.add_argument('--stats', action='store_true',
+                    help="print a summary of time spent in each phase, the "
+                         "slowest files and parse failures to stderr")
+    ap.add_argument('--serve', action='store_true',
+                    help="answer JSON search requests on stdin, keeping "
+                         "parsed files from the path in memory")
+    ap.add_argument('--socket', metavar='PATH',
+                    help="with --serve, listen on a Unix socket instead of "
+                         "stdin")
+    ap.add_argument('--merge', nargs='+', metavar='FILE',
+                    help="instead of searching, combine the --format jsonl "
+                         "output of several searches, e.g. shards, into one "
+                         "report ordered by path & position ('-' reads stdin)")
+    ap.add_argument('-o', '--output', metavar='FILE',
+                    help="with --merge, write the merged results to FILE "
+                         "instead of stdout")
     ap.add_argument('--debug', action='store_true', help=argparse.SUPPRESS)
 
     args = ap.parse_args(argv)
-    ast_pattern = prepare_pattern(args.pattern)
-    if args.debug:
-        print(ast.dump(ast_pattern))
-
-    patternfinder = ASTPatternFinder(ast_pattern)
+    if args.merge:
+        if args.pattern is not None or args.paths:
+            ap.error("--merge takes only results files, not a pattern or paths")
+        return _merge_files(args.merge, args.output)
+    make_index = args.build_index or args.update_index
+    if args.rules or args.serve or args.duplicates or make_index:
+        # The positional arguments are then all paths
+        if args.pattern is not None:
+            args.paths.insert(0, args.pattern)
+    elif args.pattern is None:
+        ap.error("A pattern or --rules is required")
+    if not (args.paths or args.files_from):
+        args.paths = ['.']
+    for path in args.paths:
+        if not os.path.exists(path):
+            sys.exit("No such file or directory: {}".format(path))
+    # Options which work on one directory
+    single_dir = None
+    if len(args.paths) == 1 and not args.files_from \
+            and os.path.isdir(args.paths[0]):
+        single_dir = args.paths[0]
+
+    if make_index:
+        if single_dir is None:
+            ap.error("--build-index and --update-index need a single directory")
+        return _make_index(single_dir, args)
+    if single_dir is None:
+        # Files from other sources would be searched in every shard, and the
+        # index is for one directory.
+        if args.shard:
+            ap.error("--shard needs a single directory to search")
+        if args.index or args.index_file:
+            ap.error("--index needs a single directory to search")
+
+    if args.serve:
+        if single_dir is None:
+            ap.error("--serve needs a single directory to search")
+        server = QueryServer(single_dir)
+        if args.socket:
+            server.serve_unix(args.socket)
+        else:
+            server.serve_stream(sys.stdin.buffer, sys.stdout.buffer)
+        return
+
+    cache = None
+    if args.cache or args.cache_dir:
+        cache = ASTCache(args.cache_dir)
+    stats = ScanStats() if args.stats else None
+    index = None
+    if args.index or args.index_file:
+        index = ASTIndex(single_dir, args.index_file)
+        if not index.load():
+            warnings.warn("No index found for {}; searching all files. Create "
+                          "one with --build-index".format(single_dir))
+            index = None
+
+    within = compile_pattern(args.within) if args.within else None
+    if args.duplicates:
+        if args.rev:
+            ap.error("--duplicates can't be used with --rev")
+        # Only used to list the files to search
+        patternfinder = ASTPatternFinder(prepare_pattern('?'))
+    elif args.rules:
+        patternfinder = MultiPatternFinder(load_rules(args.rules), cache=cache,
+                                           max_depth=args.max_depth,
+                                           hooks=stats, index=index,
+                                           within=within)
+        if args.debug:
+            for name, ast_pattern in patternfinder.patterns.items():
+                print(name, ast.dump(ast_pattern))
+    else:
+        compiled = compile_pattern(args.pattern)
+        patternfinder = ASTPatternFinder(compiled, cache=cache,
+                                         max_depth=args.max_depth, hooks=stats,
+                                         index=index, within=within)
+        if args.debug:
+            print(ast.dump(compiled.pattern))
+            print(patternfinder.matcher.source)
 
     if getattr(args, 'max_lines'):
-        def _printline(node, filelines):
+        def _printline(node, source):
             for lineno in range(node.lineno, node.end_lineno + 1)[:args.max_lines]:
-                print("{:>4}│{}".format(lineno, filelines[lineno - 1].rstrip()))
+                out.write("{:>4}│{}\n".format(lineno, source.line(lineno).rstrip()))
             elided = max(node.end_lineno + 1 - node.lineno - args.max_lines, 0)
             if elided:
-                print("    └<{} more line{}>".format(elided, ['', 's'][elided > 1]))
-            print()
+                out.write("    └<{} more line{}>\n".format(elided, ['', 's'][elided > 1]))
+            out.write("\n")
     else:
-        def _printline(node, filelines):
-            print("{:>4}|{}".format(node.lineno, filelines[node.lineno-1].rstrip()))
-
-    current_filelines = []
-    if os.path.isdir(args.path):
-        # Search directory
-        current_filepath = None
-        if args.files_with_matches:
-            for filepath, node in patternfinder.scan_directory(args.path):
-                if filepath != current_filepath:
-                    print(filepath)
-                    current_filepath = filepath
-        else:
-            for filepath, node in patternfinder.scan_directory(args.path):
-                if filepath != current_filepath:
-                    with tokenize.open(filepath) as f:
-                        current_filelines = f.readlines()
-                    if current_filepath is not None:
-                        print()  # Blank line between files
-                    current_filepath = filepath
-                    print(filepath)
-                _printline(node, current_filelines)
-
-    elif os.path.exists(args.path):
-        # Search file
-        if args.files_with_matches:
-            try:
-                node = next(patternfinder.scan_file(args.path))
-            except StopIteration:
-                pass
-            else:
-                print(args.path)
+        def _printline(node, source):
+            out.write("{:>4}|{}\n".format(node.lineno,
+                                          source.line(node.lineno).rstrip()))
+
+    if args.format == 'null':
+        args.files_with_matches = True
+
+    # With -l, one match is enough to list a file
+    max_per_file = 1 if args.files_with_matches else None
+    # Only a single file is shown without its name
+    show_filenames = bool(
+        len(args.paths) > 1 or args.files_from
+        or os.path.isdir(args.paths[0]) or is_archive(args.paths[0]))
+    history = None
+    if args.rev:
+        if single_dir is None:
+            sys.exit("--rev needs a directory in a git repository to search")
+        history = GitHistory(single_dir, args.rev)
+        filepaths = history.iter_sources()
+    else:
+        # Each source is only listed once the ones before it are searched,
+        # so results start to appear before all the paths are known.
+        sources = [_path_sources(patternfinder, path, args)
+                   for path in args.paths]
+        if args.files_from:
+            sources.append(_files_from_sources(patternfinder, args))
+        filepaths = chain.from_iterable(sources)
+
+    if stats is not None:
+        filepaths = stats.timed(filepaths, 'walk')
+
+    if args.duplicates:
+        finder = DuplicateFinder(args.min_size, args.normalize, cache)
+        finder.scan_files(filepaths)
+        out = BufferedOutput(sys.stdout)
+        try:
+            _write_duplicates(out, finder.groups(), args)
+        finally:
+            out.flush()
+        return
+
+    # Only positions are needed to print matches, so each file's AST can be
+    # freed once it has been searched.
+    results = patternfinder.iter_file_matches(
+        filepaths, jobs=args.jobs, max_per_file=max_per_file,
+        max_count=args.max_count, records=True, dedup=args.dedup)
+    if history is not None:
+        results = _history_results(results, history)
+    if stats is not None:
+        results = stats.timed_consumer(results, 'print')
+
+    out = BufferedOutput(sys.stdout)
+    if args.files_from == '-' or sys.stdout.isatty():
+        # Paths may arrive slowly, or someone is watching: show each file's
+        # matches as soon as they're found.
+        results = _flush_between(results, out)
+    try:
+        if args.format == 'jsonl':
+            _write_jsonl(out, results, args)
+        elif args.format == 'null':
+            for result in results:
+                out.write(result.path + '\0')
+        elif args.count:
+            counted_any = False
+            for result in results:
+                n = len(result.matches)
+                out.write("{}:{}\n".format(result.path, n) if show_filenames
+                          else "{}\n".format(n))
+                counted_any = True
+            if not (show_filenames or counted_any):
+                out.write("0\n")
         else:
-            for node in patternfinder.scan_file(args.path):
-                if not current_filelines:
-                    with tokenize.open(args.path) as f:
-                        current_filelines = f.readlines()
-                _printline(node, current_filelines)
-
+            for i, result in enumerate(results):
+                if args.files_with_matches:
+                    out.write(result.path + "\n")
+                    continue
+
+                if show_filenames:
+                    if i > 0:
+                        out.write("\n")  # Blank line between files
+                    out.write(result.path + "\n")
+
+                for match in result.matches:
+                    if args.rules:
+                        out.write("[{}]\n".format(match.rule))
+                    _printline(match, result.source)
+    finally:
+        out.flush()
+        if stats is not None:
+            stats.report(sys.stderr)
+
+def _flush_between(results, out):
+    """Flush the output after each result has been written"""
+    for result in results:
+        yield result
+        out.flush()
+
+def _path_sources(patternfinder, path, args):
+    """List the files to search for one path given on the command line"""
+    if os.path.isdir(path):
+        return patternfinder.iter_files(
+            path, git=args.git, gitignore=args.gitignore,
+            exclude=args.exclude, include=args.include,
+            skip_venvs=not args.include_venvs, shard=args.shard,
+            shard_by_size=args.shard_by_size)
+    elif is_archive(path):
+        # Search the Python files in a wheel, zip or tarball
+        return iter_archive(path)
+    return [path]
+
+def _files_from_sources(patternfinder, args):
+    """List the files to search from the paths in --files-from"""
+    if args.files_from == '-':
+        stream = sys.stdin.buffer
     else:
-        sys.exit("No such file or directory: {}".format(args.path))
+        stream = open(args.files_from, 'rb')
+    try:
+        for path in read_paths(stream, null=args.null):
+            if os.path.isdir(path) or is_archive(path):
+                yield from _path_sources(patternfinder, path, args)
+            # Lists like `git diff --name-only` include deleted & non-Python
+            # files, which are quietly skipped.
+            elif path.endswith(('.py', '.pyw')) and os.path.isfile(path):
+                yield path
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+def _parse_shard(value):
+    """Parse a shard specification like '2/5' for the --shard option"""
+    import argparse
+    try:
+        index, count = (int(n) for n in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "I must be between 1 and N, e.g. 1/4")
+    return index, count
+
+def _non_negative_int(value):
+    """Parse a count for --max-count or --jobs, which may be 0"""
+    import argparse
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected an integer")
+    if n < 0:
+        raise argparse.ArgumentTypeError("must be 0 or more")
+    return n
+
+def _merge_files(paths, output=None):
+    """Combine JSON Lines results files for ``astsearch --merge``"""
+    infiles = []
+    try:
+        for path in paths:
+            infiles.append(sys.stdin if path == '-'
+                           else open(path, encoding='utf-8'))
+        if output:
+            with open(output, 'w', encoding='utf-8') as outfile:
+                merge_jsonl(infiles, outfile)
+        else:
+            merge_jsonl(infiles, sys.stdout)
+    finally:
+        for f in infiles:
+            if f is not sys.stdin:
+                f.close()
+
+def _make_index(directory, args):
+    """Create or update an index for --build-index or --update-index"""
+    index = ASTIndex(directory, args.index_file)
+    if args.update_index:
+        index.load()
+    # Only the directory walk is used, so any pattern will do
+    walker = ASTPatternFinder(prepare_pattern('?'))
+    changed, removed = index.update(walker.iter_files(
+        directory, git=args.git, gitignore=args.gitignore,
+        exclude=args.exclude, skip_venvs=not args.include_venvs))
+    index.save()
+    print("Indexed {} files ({} unchanged, {} removed) in {}".format(
+        changed, len(index.files) - changed, removed, index.path),
+        file=sys.stderr)
+
+def _history_results(results, history):
+    """Repeat the matches in each file version for each commit containing it
+
+    The results are named like ``commit:path``, as for ``git show``.
+    """
+    for result in results:
+        for commit, path in history.blobs[result.path]:
+            location = '{}:{}'.format(commit, path)
+            yield FileMatches(location, result.source, [
+                Match(location, m.lineno, m.col_offset, m.end_lineno,
+                      m.end_col_offset, m.type, m.rule) for m in result.matches
+            ])
+
+def _write_duplicates(out, groups, args):
+    """Write groups of duplicated code found by DuplicateFinder"""
+    import json
+    for i, (size, matches) in enumerate(groups):
+        if args.format == 'jsonl':
+            out.write(json.dumps({
+                'size': size, 'type': matches[0].type,
+                'matches': [m.as_dict() for m in matches],
+            }) + '\n')
+            continue
+        if i > 0:
+            out.write("\n")
+        out.write("{} copies of {} ({} nodes):\n".format(
+            len(matches), matches[0].type, size))
+        for m in matches:
+            out.write("  {}:{}-{}\n".format(m.path, m.lineno, m.end_lineno))
+
+def _write_jsonl(out, results, args):
+    """Write search results as JSON Lines, one object per line"""
+    import json
+    for result in results:
+        if args.files_with_matches or args.count:
+            record = {'path': result.path}
+            if args.count:
+                record['count'] = len(result.matches)
+            out.write(json.dumps(record) + '\n')
+            continue
+
+        for match in result.matches:
+            record = match.as_dict()
+            if args.snippets:
+                record['source'] = '\n'.join(result.source.line(l)
+                    for l in range(match.lineno, match.end_lineno + 1))
+            out.write(json.dumps(record) + '\n')
 
 if __name__ == '__main__':
     main()
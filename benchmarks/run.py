@@ -0,0 +1,231 @@
+"""Benchmarks for astsearch
+
+Run from the repository root::
+
+    python benchmarks/run.py                      # Print results
+    python benchmarks/run.py -o before.json       # Save results as JSON
+    python benchmarks/run.py --compare before.json after.json
+
+The benchmarks run on a synthetic corpus of Python files, generated from a
+fixed random seed, so they work offline and give comparable numbers between
+commits. Each stage is timed on its own: preparing patterns, matching
+already-parsed ASTs, scanning a directory from disk, and loading from a warm
+ASTCache. Peak memory is measured with tracemalloc in a separate run of each
+stage, so that tracing doesn't distort the timings.
+"""
+import argparse
+import ast
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import astsearch  # noqa: E402
+
+PATTERNS = {
+    'wildcard-binop': '?/?',
+    'attr-call-kwarg': 'subprocess.call(??, shell=True)',
+    'call-any-args': 'open(??)',
+    'body-wildcard': 'if ?: ??\nelse: ??',
+    'funcdef-signature': 'def ?(self, ??, timeout=?): ??',
+    'bare-except': 'try: ??\nexcept: ??',
+    'import-from': 'from os import ?',
+}
+
+NAMES = ['data', 'result', 'value', 'item', 'config', 'path', 'count', 'node',
+         'timeout', 'buffer', 'index', 'key', 'cache', 'parent', 'options']
+
+# Snippets for the corpus generator; {n} & {m} are filled with names
+SNIPPETS = [
+    "{n} = {m} / 2",
+    "{n} = {m} // 3 + len({m})",
+    "{n} = [x * 2 for x in {m} if x]",
+    "{n} = {{k: v for k, v in {m}.items()}}",
+    "subprocess.call(['ls', {m}], shell=True)",
+    "subprocess.run([{m}], check=True)",
+    "with open({m}) as f:\n    {n} = f.read()",
+    "if {n}:\n    {m} = {n}\nelse:\n    {m} = None",
+    "try:\n    {n} = int({m})\nexcept:\n    {n} = 0",
+    "try:\n    {n}.close()\nexcept OSError as e:\n    print(e)",
+    "for {n} in range({m}):\n    total += {n}",
+    "while {n} > 0:\n    {n} -= 1",
+    "{n}.update({m}, key='{m}', default=None)",
+    "assert {n} is not None, 'missing {n}'",
+]
+
+def _indent(code, level):
+    return '\n'.join('    ' * level + line for line in code.splitlines())
+
+def generate_module(rng, n_functions):
+    lines = ["import os", "import subprocess", "from os import path", ""]
+    for i in range(n_functions):
+        if rng.random() < 0.3:
+            lines.append("class C{}:".format(i))
+            args = ['self'] + rng.sample(NAMES, rng.randint(0, 3))
+            if rng.random() < 0.5:
+                args.append('timeout=10')
+            lines.append("    def m{}({}):".format(i, ', '.join(args)))
+            level = 2
+        else:
+            args = rng.sample(NAMES, rng.randint(0, 4))
+            lines.append("def f{}({}):".format(i, ', '.join(args)))
+            level = 1
+        for _ in range(rng.randint(2, 12)):
+            n, m = rng.sample(NAMES, 2)
+            lines.append(_indent(rng.choice(SNIPPETS).format(n=n, m=m), level))
+        lines.append(_indent("return {}".format(rng.choice(NAMES)), level))
+        lines.append("")
+    return '\n'.join(lines) + '\n'
+
+def generate_corpus(directory, n_files, seed=0):
+    """Write n_files synthetic Python modules under directory"""
+    rng = random.Random(seed)
+    for i in range(n_files):
+        subdir = os.path.join(directory, 'pkg{}'.format(i % 20))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'mod{}.py'.format(i)), 'w') as f:
+            f.write(generate_module(rng, rng.randint(3, 30)))
+
+def measure(func, repeat):
+    """Run func repeat times; return (best wall time, peak traced bytes)"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+def run_benchmarks(corpus, repeat):
+    results = {}
+
+    def record(name, func, n_files=None):
+        wall, peak = measure(func, repeat)
+        entry = {'wall_s': wall, 'peak_mem_bytes': peak}
+        if n_files:
+            entry['files_per_s'] = n_files / wall
+        results[name] = entry
+        print("{:<40} {:>9.4f}s {:>10.1f} KiB{}".format(
+            name, wall, peak / 1024,
+            "  {:>8.0f} files/s".format(entry['files_per_s']) if n_files else ""))
+
+    finders = {name: astsearch.ASTPatternFinder(astsearch.prepare_pattern(p))
+               for name, p in PATTERNS.items()}
+    filepaths = sorted(next(iter(finders.values())).iter_files(corpus))
+
+    def parse_all():
+        trees = []
+        for filepath in filepaths:
+            with open(filepath, 'rb') as f:
+                trees.append(ast.parse(f.read()))
+        return trees
+
+    trees = parse_all()
+
+    record('prepare_pattern (all patterns x100)', lambda: [
+        astsearch.prepare_pattern(p) for _ in range(100) for p in PATTERNS.values()
+    ])
+    record('walk directory', lambda: list(
+        next(iter(finders.values())).iter_files(corpus)), len(filepaths))
+    record('read + ast.parse', parse_all, len(filepaths))
+
+    for name, finder in finders.items():
+        record('scan_ast: ' + name, lambda: [
+            list(finder.scan_ast(t)) for t in trees], len(trees))
+
+    for name, finder in finders.items():
+        record('scan_directory: ' + name,
+               lambda: list(finder.scan_directory(corpus)), len(filepaths))
+
+    # A warm cache should beat parsing, and skip files which can't match
+    # without loading their ASTs.
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = astsearch.ASTCache(cache_dir)
+        for filepath in filepaths:
+            cache.parse(filepath)
+        record('ASTCache.parse (warm)', lambda: [
+            cache.parse(p) for p in filepaths], len(filepaths))
+        for name in ['attr-call-kwarg', 'body-wildcard']:
+            finder = astsearch.ASTPatternFinder(
+                astsearch.prepare_pattern(PATTERNS[name]), cache=cache)
+            record('scan_directory (warm cache): ' + name,
+                   lambda: list(finder.scan_directory(corpus)), len(filepaths))
+
+    return results
+
+def compare(before_path, after_path, threshold):
+    """Print a comparison of two results files; return True if no regressions"""
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    ok = True
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name]['wall_s'], after[name]['wall_s']
+        change = (new - old) / old
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            ok = False
+        elif change < -threshold:
+            flag = '  faster'
+        print("{:<40} {:>9.4f}s -> {:>9.4f}s {:>+7.1%}{}".format(
+            name, old, new, change, flag))
+    for name in sorted(set(before) ^ set(after)):
+        print("{:<40} only in {}".format(
+            name, before_path if name in before else after_path))
+    return ok
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('-n', '--files', type=int, default=300,
+                    help="number of files in the synthetic corpus")
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help="timing runs per stage; the best is reported")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--corpus', metavar='DIR',
+                    help="generate the corpus here instead of a temporary "
+                         "directory (reused if it already exists)")
+    ap.add_argument('-o', '--output', metavar='FILE',
+                    help="write results as JSON to FILE")
+    ap.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                    help="compare two JSON results files instead of running")
+    ap.add_argument('--threshold', type=float, default=0.1,
+                    help="relative slowdown counted as a regression by "
+                         "--compare (default 0.1 = 10%%)")
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        return 0 if compare(*args.compare, threshold=args.threshold) else 1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus = args.corpus or os.path.join(tmpdir, 'corpus')
+        if not os.path.isdir(corpus):
+            generate_corpus(corpus, args.files, args.seed)
+        results = run_benchmarks(corpus, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'astsearch_version': astsearch.__version__,
+                'python': platform.python_version(),
+                'files': args.files,
+                'seed': args.seed,
+                'results': results,
+            }, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
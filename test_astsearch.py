@@ -1,14 +1,23 @@
 import ast
-from io import StringIO
-import types
+from io import BytesIO, StringIO
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import threading
 import unittest
 
 import pytest
 
-from astcheck import assert_ast_like, listmiddle, name_or_attr
+from astcheck import assert_ast_like, is_ast_like, listmiddle, name_or_attr
 from astsearch import (
     prepare_pattern, ASTPatternFinder, must_exist_checker, must_not_exist_checker,
-    ArgsDefChecker,
+    ArgsDefChecker, ASTCache, pattern_literals, MultiPatternFinder, load_rules,
+    compile_matcher, walk_pruned, main, QueryServer, GitIgnore, git_files,
+    SourceBuffer, ScanHooks, KeywordsChecker, CompiledPattern, compile_pattern,
+    Match, iter_archive, GitHistory, shard_files, ASTIndex, pattern_index_terms,
+    DuplicateFinder, read_paths,
 )
 
 def assert_iterator_finished(it):
@@ -75,13 +84,13 @@ def test_wildcard_some_call_args():
 def test_wildcard_call_keywords():
     pat = prepare_pattern("f(a=1, ??=??)")
     assert pat.args == must_not_exist_checker
-    assert isinstance(pat.keywords, types.FunctionType)
+    assert isinstance(pat.keywords, KeywordsChecker)
 
 def test_wildcard_call_mixed_args():
     pat = prepare_pattern("f(1, ??, a=2, **{'b':3})")
     assert isinstance(pat.args, listmiddle)
     assert_ast_like(pat.args.front[0], ast.Constant(1))
-    assert isinstance(pat.keywords, types.FunctionType)
+    assert isinstance(pat.keywords, KeywordsChecker)
     kwargs_dict = ast.Dict(keys=[ast.Constant('b')], values=[ast.Constant(3)])
     pat.keywords([ast.keyword(arg=None, value=kwargs_dict),
                   ast.keyword(arg='a', value=ast.Constant(2))], [])
@@ -306,3 +315,930 @@ class FuncDefTests(unittest.TestCase):
     def test_mix_wildcards(self):
         matches = self.get_matching_names("def ?(?, ??): ??")
         assert matches == {'g', 'h', 'i', 'k', 'm', 'n'}
+
+
+# Test scanning directories -----------------------------------------------
+
+@pytest.fixture
+def sample_dir(tmp_path):
+    (tmp_path / 'a.py').write_text(division_sample)
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / 'b.py').write_text("x = 3/4\n")
+    (tmp_path / 'pkg' / 'c.txt').write_text("5/6\n")
+    (tmp_path / 'build').mkdir()
+    (tmp_path / 'build' / 'd.py').write_text("7/8\n")
+    return tmp_path
+
+def test_scan_directory(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    matches = [(os.path.relpath(p, sample_dir), n.lineno)
+               for p, n in apf.scan_directory(str(sample_dir))]
+    assert sorted(matches) == [('a.py', 3), ('a.py', 4), ('a.py', 9),
+                               (os.path.join('pkg', 'b.py'), 1)]
+
+def test_scan_directory_parallel(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    serial = list(apf.scan_directory(str(sample_dir)))
+    parallel = list(apf.scan_directory(str(sample_dir), jobs=2))
+    assert sorted((p, n.lineno) for p, n in parallel) \
+        == sorted((p, n.lineno) for p, n in serial)
+
+def test_scan_directory_dedup(sample_dir):
+    shutil.copy(str(sample_dir / 'a.py'), str(sample_dir / 'pkg' / 'a2.py'))
+    (sample_dir / 'pkg' / 'e.py').write_text("x = 3/4\n")  # Same as b.py
+    hooks = RecordingHooks()
+    apf = ASTPatternFinder(prepare_pattern('?/?'), hooks=hooks)
+    for jobs in (1, 2):
+        matches = [(os.path.relpath(m.path, sample_dir), m.lineno) for m in
+                   apf.scan_directory(str(sample_dir), jobs=jobs, records=True,
+                                      dedup=True)]
+        assert sorted(matches) == [
+            ('a.py', 3), ('a.py', 4), ('a.py', 9),
+            (os.path.join('pkg', 'a2.py'), 3), (os.path.join('pkg', 'a2.py'), 4),
+            (os.path.join('pkg', 'a2.py'), 9), (os.path.join('pkg', 'b.py'), 1),
+            (os.path.join('pkg', 'e.py'), 1),
+        ]
+    # Only 2 of the 4 files were parsed in each search
+    parsed = [e for e in hooks.events if e[0] == 'parsed']
+    assert len(parsed) == 8
+    assert sum(not skipped for _, _, skipped in parsed) == 4
+
+def test_cli_dedup(sample_dir, capsys):
+    (sample_dir / 'pkg' / 'e.py').write_text("x = 3/4\n")
+    main(['--dedup', '?/?', str(sample_dir / 'pkg')])
+    out = capsys.readouterr().out
+    assert out.count("   1|x = 3/4") + out.count("   1│x = 3/4") == 2
+    assert str(sample_dir / 'pkg' / 'e.py') in out
+
+def test_scan_directory_cached(sample_dir, tmp_path_factory):
+    cache = ASTCache(str(tmp_path_factory.mktemp('cache')))
+    apf = ASTPatternFinder(prepare_pattern('?/?'), cache=cache)
+    first = sorted((p, n.lineno) for p, n in apf.scan_directory(str(sample_dir)))
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    second = sorted((p, n.lineno) for p, n in apf.scan_directory(str(sample_dir)))
+    assert second == first
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Changed content is parsed again
+    (sample_dir / 'pkg' / 'b.py').write_text("x = 3/4\ny = 5/6\n")
+    third = list(apf.scan_directory(str(sample_dir)))
+    assert len(third) == len(first) + 1
+    assert (cache.hits, cache.misses) == (3, 3)
+
+def test_cache_prefilter(sample_dir, tmp_path_factory, monkeypatch):
+    cache = ASTCache(str(tmp_path_factory.mktemp('cache')))
+    # Files which can't match are cached without their ASTs...
+    apf = ASTPatternFinder(prepare_pattern('zzz = ?/?'), cache=cache)
+    assert [(os.path.basename(p), n.lineno)
+            for p, n in apf.scan_directory(str(sample_dir))] == []
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    # ...and parsed later when a pattern needs them
+    apf = ASTPatternFinder(prepare_pattern('x = ?/?'), cache=cache)
+    assert [(os.path.basename(p), n.lineno)
+            for p, n in apf.scan_directory(str(sample_dir))] == [('b.py', 1)]
+    assert (cache.hits, cache.misses) == (0, 4)
+
+    entries = {p: os.stat(p).st_mtime_ns for _, _, p in cache._entries()}
+    def no_unpickling(data):
+        raise AssertionError("AST loaded for a file which can't match")
+    monkeypatch.setattr(pickle, 'loads', no_unpickling)
+    apf = ASTPatternFinder(prepare_pattern('zzz = ?/?'), cache=cache)
+    assert list(apf.scan_directory(str(sample_dir))) == []
+    assert (cache.hits, cache.misses) == (2, 4)
+    # Hits don't write to the cache
+    assert {p: os.stat(p).st_mtime_ns for _, _, p in cache._entries()} == entries
+
+def test_cache_eviction(sample_dir, tmp_path_factory):
+    cache = ASTCache(str(tmp_path_factory.mktemp('cache')), max_size=1)
+    apf = ASTPatternFinder(prepare_pattern('?/?'), cache=cache)
+    list(apf.scan_directory(str(sample_dir)))
+    assert list(cache._entries()) == []
+
+def test_pickle_finder(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('f(a=1, ??=??)'))
+    apf2 = pickle.loads(pickle.dumps(apf))
+    assert apf2.literals == {'f', 'a'}
+    assert apf2.matcher(ast.parse('f(b=2, a=1)').body[0].value)
+    assert not apf2.matcher(ast.parse('f(b=2)').body[0].value)
+
+# Test compiled patterns -------------------------------------------------------
+
+def test_compile_pattern_cached():
+    compiled = compile_pattern('subprocess.call(??, shell=True)')
+    assert compile_pattern('subprocess.call(??, shell=True)') is compiled
+    assert compiled.literals == {'subprocess', 'call', 'shell'}
+
+    # Pickled as the pattern text, so loading it hits the cache
+    assert pickle.loads(pickle.dumps(compiled)) is compiled
+
+def test_pickle_compiled_pattern():
+    for text in ['f(a=1, ??=??)', 'def ?(a, b=2, *, c): ??', 'try: ??\nexcept: ??']:
+        compiled = CompiledPattern(prepare_pattern(text))
+        loaded = pickle.loads(pickle.dumps(compiled))
+        assert loaded.literals == compiled.literals
+        sample = ast.parse(text.replace('??=??', 'x=2').replace('??', 'pass')
+                               .replace('?', 'g')).body[0]
+        if isinstance(sample, ast.Expr):
+            sample = sample.value
+        assert loaded.matcher(sample) and compiled.matcher(sample)
+
+
+# Test the literal prefilter --------------------------------------------------
+
+def test_pattern_literals():
+    assert pattern_literals(prepare_pattern('subprocess.call(??, shell=True)')) \
+        == {'subprocess', 'call', 'shell'}
+    assert pattern_literals(prepare_pattern('?/?')) == set()
+    assert pattern_literals(prepare_pattern('def ?(a, ??, b=1): ??')) == {'a', 'b'}
+    assert pattern_literals(prepare_pattern('from os.path import join as j')) \
+        == {'os', 'path', 'join', 'j'}
+    assert pattern_literals(prepare_pattern('"foo"')) == set()
+
+def test_prefilter_skips_parsing():
+    apf = ASTPatternFinder(prepare_pattern('f(shell=?)'))
+    assert apf.may_match(b'f(shell=True)')
+    assert not apf.may_match(b'f(she=True)')
+    # Invalid code is never parsed if it doesn't contain the names
+    assert list(apf.scan_file(StringIO("def (:\n"))) == []
+    with pytest.raises(SyntaxError):
+        list(apf.scan_file(StringIO("def (shell:\n")))
+
+
+# Test matching several patterns at once ---------------------------------------
+
+def test_multi_pattern_scan_ast():
+    mpf = MultiPatternFinder({
+        'div': prepare_pattern('?/?'),
+        'floordiv': prepare_pattern('?//?'),
+        'divide-def': prepare_pattern('def divide(??): ??'),
+    })
+    matches = [(name, node.lineno)
+               for name, node in mpf.scan_ast(ast.parse(division_sample))]
+    assert sorted(matches) == [('div', 3), ('div', 4), ('div', 9),
+                               ('divide-def', 8), ('floordiv', 6)]
+
+def test_multi_pattern_rules_file(sample_dir):
+    rules = load_rules(StringIO('{"div": "?/?", "eq": "? == ?"}'))
+    assert set(rules) == {'div', 'eq'}
+    # Rules share the cache of compiled patterns, and pickle as their text
+    assert rules['div'] is compile_pattern('?/?')
+    mpf = MultiPatternFinder(rules)
+    assert mpf.compiled['eq'] is rules['eq']
+    pickled = pickle.dumps(mpf)
+    assert b'?/?' in pickled and b'BinOp' not in pickled
+    mpf2 = pickle.loads(pickled)
+    assert mpf2.patterns['div'] is rules['div'].pattern
+    assert mpf.literals == set()
+    matches = sorted((name, os.path.relpath(path, sample_dir), node.lineno)
+                     for name, path, node in mpf.scan_directory(str(sample_dir)))
+    assert matches == [('div', 'a.py', 3), ('div', 'a.py', 4), ('div', 'a.py', 9),
+                       ('div', os.path.join('pkg', 'b.py'), 1)]
+
+def test_multi_pattern_prefilter():
+    mpf = MultiPatternFinder({'a': prepare_pattern('foo(?)'),
+                              'b': prepare_pattern('bar.baz')})
+    assert mpf.may_match(b'x.baz(bar)')
+    assert not mpf.may_match(b'bar(x)')
+
+
+# Test compiled matchers ----------------------------------------------------------
+
+@pytest.mark.parametrize('pattern', [
+    '?/?', '1/2', 'a.b', 'if ?: ??\nelse: ??', 'def foo():\n  ??\n  return a',
+    '?(??)', '?(1, ??)', '?(??, 2)', '?(e=4, ??=??)', '?(?, ??)',
+    'def ?(a, ??): ??', 'def ?(*, c, ??): ??', 'def ?(a, b=2, ??=??): ??',
+    'import ?', 'from ? import ?', 'try: ??\nexcept: ??', 'global x',
+])
+def test_compiled_matcher_agrees(pattern):
+    pat = prepare_pattern(pattern)
+    matcher = compile_matcher(pat)
+    for sample in [division_sample, if_sample, func_call_sample, func_def_samples]:
+        for node in ast.walk(ast.parse(sample)):
+            assert matcher(node) == is_ast_like(node, pat), ast.dump(node)
+
+
+# Test the pruned tree walker ---------------------------------------------------
+
+nested_sample = """
+def f(a=lambda: 1):
+    def g():
+        class C:
+            def h(self): pass
+    return g
+
+class D:
+    def i(self): pass
+"""
+
+def test_walk_pruned_matches_walk():
+    tree = ast.parse(nested_sample + func_def_samples)
+    for nodetype in (ast.FunctionDef, ast.Lambda, ast.Name, ast.arguments):
+        visited = list(walk_pruned(tree, nodetype))
+        assert [n for n in visited if isinstance(n, nodetype)] \
+            == [n for n in ast.walk(tree) if isinstance(n, nodetype)]
+
+def test_walk_pruned_skips_expressions():
+    tree = ast.parse(nested_sample)
+    visited = list(walk_pruned(tree, ast.FunctionDef))
+    assert not any(isinstance(n, (ast.Lambda, ast.Constant)) for n in visited)
+
+def test_max_depth():
+    pat = prepare_pattern('def ?(??): ??')
+    def names(max_depth):
+        apf = ASTPatternFinder(pat, max_depth=max_depth)
+        return {f.name for f in apf.scan_ast(ast.parse(nested_sample))}
+    assert names(0) == {'f'}
+    assert names(1) == {'f', 'g', 'i'}
+    assert names(None) == {'f', 'g', 'h', 'i'}
+
+
+# Test searching within enclosing code ---------------------------------------------
+
+within_sample = """\
+def f():
+    open(a)
+
+async def g():
+    open(b)
+    async def h():
+        open(c)
+
+class T(TestCase):
+    def test_x(self):
+        open(d)
+"""
+
+def test_within():
+    tree = ast.parse(within_sample)
+    apf = ASTPatternFinder(prepare_pattern('open(?)'),
+                           within=prepare_pattern('async def ?(??): ??'))
+    assert [n.args[0].id for n in apf.scan_ast(tree)] == ['b', 'c']
+    assert apf.literals == {'open'}
+
+    apf = ASTPatternFinder(prepare_pattern('open(?)'),
+                           within=prepare_pattern('class ?(TestCase): ??'))
+    assert [n.args[0].id for n in apf.scan_ast(tree)] == ['d']
+    assert apf.literals == {'open', 'TestCase'}
+    assert not apf.may_match(b'open(x)')
+
+    mpf = MultiPatternFinder({'open': prepare_pattern('open(?)')},
+                             within=prepare_pattern('def ?(): ??'))
+    assert [(r, n.args[0].id) for r, n in mpf.scan_ast(tree)] == [('open', 'a')]
+
+def test_cli_within(tmp_path, capsys):
+    (tmp_path / 'w.py').write_text(within_sample)
+    main(['--within', 'async def ?(??): ??', '--format', 'jsonl', 'open(?)',
+          str(tmp_path / 'w.py')])
+    lines = [json.loads(l)['lineno'] for l in capsys.readouterr().out.splitlines()]
+    assert lines == [5, 7]
+
+
+# Test limiting and counting results ----------------------------------------------
+
+def test_max_per_file(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    matches = list(apf.scan_directory(str(sample_dir), max_per_file=1))
+    assert sorted(os.path.basename(p) for p, n in matches) == ['a.py', 'b.py']
+
+def test_max_count(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    assert len(list(apf.scan_directory(str(sample_dir), max_count=2))) == 2
+    assert len(list(apf.scan_directory(str(sample_dir), jobs=2, max_count=2))) == 2
+
+def test_max_count_zero(sample_dir):
+    hooks = RecordingHooks()
+    apf = ASTPatternFinder(prepare_pattern('?/?'), hooks=hooks)
+    assert list(apf.scan_directory(str(sample_dir), max_count=0)) == []
+    assert hooks.events == []
+
+@pytest.mark.parametrize('option', ['--max-count', '--jobs'])
+@pytest.mark.parametrize('value', ['-1', 'x'])
+def test_cli_count_options_invalid(sample_dir, option, value):
+    with pytest.raises(SystemExit) as exc_info:
+        main([option, value, '?/?', str(sample_dir)])
+    assert exc_info.value.code == 2
+
+def test_cli_count(sample_dir, capsys):
+    main(['--count', '?/?', str(sample_dir)])
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(lines) == [str(sample_dir / 'a.py') + ':3',
+                             str(sample_dir / 'pkg' / 'b.py') + ':1']
+
+    main(['--count', 'foo(?)', str(sample_dir / 'a.py')])
+    assert capsys.readouterr().out == '0\n'
+
+
+# Test the query server ------------------------------------------------------------
+
+def test_query_server(sample_dir):
+    server = QueryServer(str(sample_dir))
+    r1 = server.handle({'id': 1, 'pattern': '?/?'})
+    assert r1['id'] == 1
+    assert sorted(m['lineno'] for m in r1['matches']) == [1, 3, 4, 9]
+    assert server.cache.misses == 2
+
+    (sample_dir / 'pkg' / 'b.py').write_text("x = 3/4\ny = 5/6\n")
+    r2 = server.handle({'pattern': '?/?'})
+    assert len(r2['matches']) == 5
+    stats = server.handle({'cmd': 'stats'})['stats']
+    assert (stats['cache_hits'], stats['cache_misses']) == (1, 3)
+    assert stats['queries'] == 2
+
+    assert 'error' in server.handle({'pattern': '?/'})
+
+@pytest.mark.parametrize('request_', [
+    {'id': 3},
+    {'id': 3, 'pattern': ''},
+    {'id': 3, 'pattern': 5},
+    {'id': 3, 'pattern': '?/?', 'max_depth': 'a'},
+    {'id': 3, 'pattern': '?/?', 'max_count': -1},
+    {'id': 3, 'cmd': ['search']},
+])
+def test_query_server_bad_requests(sample_dir, request_):
+    response = QueryServer(str(sample_dir)).handle(request_)
+    assert response['id'] == 3
+    assert 'error' in response
+    assert 'matches' not in response
+
+def test_query_server_stream(sample_dir):
+    server = QueryServer(str(sample_dir))
+    infile = BytesIO(b'{"id": "a", "pattern": "?/?", "max_count": 1}\n\nnonsense\n'
+                     b'[1]\n{"pattern": ""}\n{"pattern": 5}\n'
+                     b'{"pattern": "?/?", "max_depth": "a"}\n{"id": "b", "pattern": "?/?"}\n')
+    outfile = BytesIO()
+    server.serve_stream(infile, outfile)
+    responses = [json.loads(l) for l in outfile.getvalue().splitlines()]
+    assert len(responses) == 7
+    assert responses[0]['id'] == 'a'
+    assert len(responses[0]['matches']) == 1
+    assert all('error' in r for r in responses[1:6])
+    # The server keeps answering after bad requests
+    assert responses[6]['id'] == 'b'
+    assert len(responses[6]['matches']) == 4
+
+
+# Test choosing files with git -----------------------------------------------------
+
+def test_gitignore_patterns(tmp_path):
+    (tmp_path / '.gitignore').write_text(
+        "# comment\n*.pyc\nbuild/\n/top.py\ndocs/**/gen_*.py\n!keep.pyc\n")
+    ignore = GitIgnore()
+    ignore.load(str(tmp_path))
+    def ignored(relpath, is_dir=False):
+        return ignore.ignored(str(tmp_path / relpath), is_dir=is_dir)
+    assert ignored('a.pyc')
+    assert ignored('sub/a.pyc')
+    assert not ignored('keep.pyc')
+    assert ignored('sub/build', is_dir=True)
+    assert not ignored('sub/build')  # A file, not a directory
+    assert ignored('top.py')
+    assert not ignored('sub/top.py')
+    assert ignored('docs/gen_a.py')
+    assert ignored('docs/x/y/gen_a.py')
+    assert not ignored('src/gen_a.py')
+
+def test_iter_files_gitignore(sample_dir):
+    (sample_dir / '.gitignore').write_text("b.py\n")
+    (sample_dir / 'venv').mkdir()
+    (sample_dir / 'venv' / '.gitignore').write_text("*\n")
+    (sample_dir / 'venv' / 'e.py').write_text("1/2\n")
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    found = {os.path.relpath(p, sample_dir)
+             for p in apf.iter_files(str(sample_dir), gitignore=True)}
+    assert found == {'a.py'}
+
+def test_iter_files_gitignore_skips_git_dir(sample_dir):
+    (sample_dir / '.git' / 'hooks').mkdir(parents=True)
+    (sample_dir / '.git' / 'hooks' / 'hook.py').write_text("1/2\n")
+    (sample_dir / 'pkg' / '.git').mkdir()
+    (sample_dir / 'pkg' / '.git' / 'e.py').write_text("1/2\n")
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    found = {os.path.relpath(p, sample_dir).replace(os.sep, '/')
+             for p in apf.iter_files(str(sample_dir), gitignore=True)}
+    assert found == {'a.py', 'pkg/b.py'}
+    found = {os.path.relpath(p, sample_dir).replace(os.sep, '/')
+             for p in apf.iter_files(str(sample_dir))}
+    assert '.git/hooks/hook.py' in found
+
+def test_iter_files_nested_gitignores(tmp_path):
+    expected = set()
+    for i in range(30):
+        d = tmp_path / 'pkg{}'.format(i)
+        (d / 'sub').mkdir(parents=True)
+        (d / '.gitignore').write_text("skip{}.py\n".format(i))
+        (d / 'sub' / '.gitignore').write_text("!skip{}.py\nextra.py\n".format(i))
+        for name in ['skip{}.py'.format(i), 'skip{}.py'.format(i + 1), 'extra.py']:
+            (d / name).write_text("1/2\n")
+            (d / 'sub' / name).write_text("1/2\n")
+        expected |= {'pkg{}/skip{}.py'.format(i, i + 1), 'pkg{}/extra.py'.format(i),
+                     'pkg{}/sub/skip{}.py'.format(i, i),
+                     'pkg{}/sub/skip{}.py'.format(i, i + 1)}
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    found = {os.path.relpath(p, tmp_path).replace(os.sep, '/')
+             for p in apf.iter_files(str(tmp_path), gitignore=True)}
+    assert found == expected
+
+def test_gitignore_unload(tmp_path):
+    (tmp_path / '.gitignore').write_text("a.py\n")
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / '.gitignore').write_text("b.py\n")
+    ignore = GitIgnore()
+    ignore.load(str(tmp_path))
+    ignore.load(str(tmp_path / 'sub'))
+    assert ignore.ignored(str(tmp_path / 'sub' / 'b.py'))
+    ignore.unload(str(tmp_path / 'sub'))
+    assert not ignore.ignored(str(tmp_path / 'sub' / 'b.py'))
+    assert ignore.ignored(str(tmp_path / 'sub' / 'a.py'))
+    ignore.unload(str(tmp_path))
+    assert ignore.rules == []
+
+@pytest.mark.skipif(shutil.which('git') is None, reason="git not available")
+def test_git_files(sample_dir):
+    def git(*args):
+        subprocess.run(['git'] + list(args), cwd=str(sample_dir), check=True,
+                       stdout=subprocess.DEVNULL)
+    git('init', '-q')
+    (sample_dir / '.gitignore').write_text("pkg/\n")
+    git('add', 'a.py', 'build/d.py')
+    (sample_dir / 'new.py').write_text("1/2\n")
+    found = {os.path.relpath(p, sample_dir) for p in git_files(str(sample_dir))}
+    assert found == {'a.py', os.path.join('build', 'd.py'), 'new.py'}
+
+    os.unlink(str(sample_dir / 'a.py'))
+    found = {os.path.relpath(p, sample_dir) for p in git_files(str(sample_dir))}
+    assert found == {os.path.join('build', 'd.py'), 'new.py'}
+
+def test_git_history(sample_dir, capsys):
+    def git(*args):
+        return subprocess.run(
+            ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+            + list(args), cwd=str(sample_dir), check=True,
+            stdout=subprocess.PIPE).stdout.decode().strip()
+    git('init', '-q')
+    git('add', 'a.py', 'pkg/b.py')
+    git('commit', '-q', '-m', 'one')
+    (sample_dir / 'pkg' / 'c.py').write_text("y = 1\n")
+    git('add', 'pkg/c.py')
+    git('commit', '-q', '-m', 'two')
+    (sample_dir / 'pkg' / 'c.py').write_text("y = 1/5\n")
+    git('commit', '-q', '-a', '-m', 'three')
+    commits = git('rev-list', 'HEAD').split()
+
+    history = GitHistory(str(sample_dir), 'HEAD')
+    assert history.commits == commits
+    assert len(history.blobs) == 4  # a.py, b.py & 2 versions of c.py
+    b_blob = git('rev-parse', 'HEAD:pkg/b.py')
+    assert history.blobs[b_blob] == [(c, 'pkg/b.py') for c in commits]
+
+    hooks = RecordingHooks()
+    apf = ASTPatternFinder(prepare_pattern('?/?'), hooks=hooks)
+    found = {(c, p, n.lineno) for c, p, n in apf.scan_git_history(
+        str(sample_dir / 'pkg'), 'HEAD~1..HEAD')}
+    assert found == {(commits[0], 'pkg/b.py', 1), (commits[0], 'pkg/c.py', 1)}
+
+    # Each version of a file is only parsed once
+    hooks.events.clear()
+    matches = list(apf.scan_git_history(str(sample_dir), 'HEAD'))
+    assert len([e for e in hooks.events if e[0] == 'start']) == 4
+    assert len(matches) == 3 * 4 + 1
+
+    main(['-l', '--rev', 'HEAD~2..', '?/?', str(sample_dir)])
+    assert sorted(capsys.readouterr().out.splitlines()) == sorted(
+        ['{}:{}'.format(c, p) for c in commits[:2] for p in ['a.py', 'pkg/b.py']]
+        + ['{}:pkg/c.py'.format(commits[0])])
+
+
+# Test walking directories ----------------------------------------------------------
+
+def test_iter_files_exclude_include(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    def found(**kwargs):
+        return {os.path.relpath(p, sample_dir).replace(os.sep, '/')
+                for p in apf.iter_files(str(sample_dir), **kwargs)}
+    assert found() == {'a.py', 'pkg/b.py'}
+    assert found(exclude=['pkg']) == {'a.py'}
+    assert found(exclude=['/b.py']) == {'a.py', 'pkg/b.py'}
+    assert found(exclude=['pkg/b.py']) == {'a.py'}
+    assert found(include=['b*']) == {'pkg/b.py'}
+
+def test_iter_files_skips_venvs(sample_dir):
+    venv = sample_dir / 'env'
+    (venv / 'lib').mkdir(parents=True)
+    (venv / 'pyvenv.cfg').write_text("home = /usr/bin\n")
+    (venv / 'lib' / 'site.py').write_text("1/2\n")
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    assert len(list(apf.iter_files(str(sample_dir)))) == 2
+    assert len(list(apf.iter_files(str(sample_dir), skip_venvs=False))) == 3
+    # Searching inside a virtualenv directly still works
+    assert len(list(apf.iter_files(str(venv)))) == 1
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason="no hard links")
+def test_iter_files_dedups_links(sample_dir):
+    os.link(str(sample_dir / 'a.py'), str(sample_dir / 'pkg' / 'a_link.py'))
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    assert len(list(apf.iter_files(str(sample_dir)))) == 2
+
+
+# Test lists of paths -----------------------------------------------------------------
+
+class ChunkedStream:
+    """A stream which gives its data in pieces, like a pipe"""
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+
+    def read1(self, size=-1):
+        self.reads += 1
+        return self.chunks.pop(0) if self.chunks else b''
+
+def test_read_paths():
+    assert list(read_paths(BytesIO(b'a.py\r\nb c.py\n\nd.py'))) == \
+        ['a.py', 'b c.py', 'd.py']
+    assert list(read_paths(BytesIO(b'a\nb.py\0c.py\0'), null=True)) == \
+        ['a\nb.py', 'c.py']
+
+    stream = ChunkedStream([b'pkg/a', b'.py\npkg/', b'b.py\n'])
+    paths = read_paths(stream)
+    assert next(paths) == 'pkg/a.py'
+    assert stream.reads == 2  # Yielded before the rest was read
+    assert list(paths) == ['pkg/b.py']
+
+def test_cli_several_paths(sample_dir, capsys):
+    main(['-l', '?/?', str(sample_dir / 'a.py'), str(sample_dir / 'build')])
+    assert capsys.readouterr().out.splitlines() == [
+        str(sample_dir / 'a.py'), str(sample_dir / 'build' / 'd.py')]
+
+def test_cli_files_from(sample_dir, capsys):
+    listing = sample_dir / 'files.txt'
+    listing.write_bytes(b'\0'.join(os.fsencode(str(sample_dir / name)) for name in [
+        'build', 'deleted.py', os.path.join('pkg', 'c.txt'), 'a.py']))
+    main(['-l', '-0', '--files-from', str(listing), '?/?',
+          str(sample_dir / 'pkg' / 'b.py')])
+    assert capsys.readouterr().out.splitlines() == [
+        str(sample_dir / 'pkg' / 'b.py'), str(sample_dir / 'build' / 'd.py'),
+        str(sample_dir / 'a.py')]
+
+def test_cli_files_from_stdin_streams(sample_dir, capsys, monkeypatch):
+    output_before_read = []
+
+    class Stdin(ChunkedStream):
+        buffer = property(lambda self: self)
+
+        def read1(self, size=-1):
+            output_before_read.append(capsys.readouterr().out)
+            return super().read1(size)
+
+    paths = [str(sample_dir / 'a.py'), str(sample_dir / 'pkg' / 'b.py')]
+    monkeypatch.setattr('sys.stdin', Stdin([os.fsencode(p) + b'\n' for p in paths]))
+    main(['-l', '--files-from', '-', '?/?'])
+    # Each match is written before the next path is read
+    assert output_before_read == ['', paths[0] + '\n', paths[1] + '\n']
+
+
+# Test sharding & merging results ---------------------------------------------------
+
+@pytest.mark.parametrize('by_size', [False, True])
+def test_shard_files(tmp_path, by_size):
+    paths = []
+    for i in range(40):
+        path = tmp_path / 'm{}.py'.format(i)
+        path.write_text('x = 1\n' * i)
+        paths.append(str(path))
+
+    shards = [list(shard_files(paths, str(tmp_path), i, 3, by_size=by_size))
+              for i in [1, 2, 3]]
+    assert sorted(p for shard in shards for p in shard) == sorted(paths)
+    assert all(shards)
+    # The same files are picked whatever order they're listed in
+    assert set(shard_files(reversed(paths), str(tmp_path), 2, 3,
+                           by_size=by_size)) == set(shards[1])
+    if by_size:
+        sizes = [sum(os.path.getsize(p) for p in shard) for shard in shards]
+        assert max(sizes) - min(sizes) <= 6 * 40
+
+    with pytest.raises(ValueError):
+        list(shard_files(paths, str(tmp_path), 0, 3))
+
+def test_cli_shard_merge(sample_dir, tmp_path, capsys):
+    main(['--format', 'jsonl', '?/?', str(sample_dir)])
+    expected = capsys.readouterr().out.splitlines()
+
+    shard_outputs = []
+    for i in [1, 2]:
+        main(['--format', 'jsonl', '--shard', '{}/2'.format(i), '?/?',
+              str(sample_dir)])
+        out_file = tmp_path / 'shard{}.jsonl'.format(i)
+        out_file.write_text(capsys.readouterr().out)
+        shard_outputs.append(str(out_file))
+
+    main(['--merge'] + shard_outputs)
+    assert capsys.readouterr().out.splitlines() == sorted(
+        expected, key=lambda l: (json.loads(l)['path'], json.loads(l)['lineno']))
+
+@pytest.mark.parametrize('options', [
+    ['--shard', '1/2'], ['--index'], ['--index-file', 'idx'],
+])
+def test_cli_shard_index_need_one_directory(sample_dir, options):
+    # Explicit files would otherwise be searched in every shard
+    with pytest.raises(SystemExit) as excinfo:
+        main(options + ['?/?', str(sample_dir / 'a.py'), str(sample_dir / 'pkg')])
+    assert excinfo.value.code == 2
+    with pytest.raises(SystemExit):
+        main(options + ['--files-from', '-', '?/?'])
+
+def test_cli_merge_is_a_pattern(sample_dir, capsys):
+    # 'merge' is a search pattern, not a command
+    main(['merge', str(sample_dir / 'pkg')])
+    assert capsys.readouterr().out == ''
+
+
+# Test the index of terms in files --------------------------------------------------
+
+def test_pattern_index_terms():
+    assert pattern_index_terms(prepare_pattern('open(?, mode="w")')) \
+        == {'open', 'mode', 't:Call', 's:w'}
+    assert pattern_index_terms(prepare_pattern('?/?')) == {'t:BinOp'}
+
+def test_index(sample_dir, tmp_path):
+    (sample_dir / 'calls.py').write_text('subprocess.call(cmd, shell=True)\n')
+    (sample_dir / 'bad.py').write_text('subprocess.call(\n')
+    index = ASTIndex(str(sample_dir), str(tmp_path / 'index'))
+    assert not index.load()
+    walker = ASTPatternFinder(prepare_pattern('?'))
+    assert index.update(walker.iter_files(str(sample_dir))) == (4, 0)
+    index.save()
+
+    index = ASTIndex(str(sample_dir), str(tmp_path / 'index'))
+    assert index.load()
+    apf = ASTPatternFinder(prepare_pattern('subprocess.call(??, shell=True)'),
+                           index=index)
+    # Files which failed to parse are always searched
+    assert sorted(os.path.basename(p) for p in apf.iter_files(str(sample_dir))) \
+        == ['bad.py', 'calls.py']
+
+    # Changed files are searched until the index is updated
+    (sample_dir / 'a.py').write_text('subprocess.call(x, shell=True)\n')
+    assert len(list(apf.iter_files(str(sample_dir)))) == 3
+    assert index.update(walker.iter_files(str(sample_dir))) == (1, 0)
+    assert len(list(apf.scan_directory(str(sample_dir)))) == 2
+
+def test_cli_index(sample_dir, tmp_path, capsys):
+    index_file = str(tmp_path / 'index')
+    main(['--build-index', str(sample_dir), '--index-file', index_file])
+    main(['--index-file', index_file, '-l', '?/?', str(sample_dir)])
+    assert sorted(capsys.readouterr().out.splitlines()) == [
+        str(sample_dir / 'a.py'), str(sample_dir / 'pkg' / 'b.py')]
+
+    (sample_dir / 'pkg' / 'b.py').write_text("x = 1\n")
+    main(['--update-index', str(sample_dir), '--index-file', index_file])
+    assert 'Indexed 1 files (1 unchanged' in capsys.readouterr().err
+    main(['--index-file', index_file, '-l', '?/?', str(sample_dir)])
+    assert capsys.readouterr().out.splitlines() == [str(sample_dir / 'a.py')]
+
+    # 'index' is a search pattern, not a command
+    main(['index', str(sample_dir)])
+    assert capsys.readouterr().out == ''
+
+
+# Test finding duplicated code -----------------------------------------------------
+
+clone_sample = """\
+def f(a, b):
+    total = 0
+    for x in a:
+        if x > b:
+            total += x * 2
+    return total
+
+def g(c, d):
+    acc = 0
+    for y in c:
+        if y > d:
+            acc += y * 3
+    return acc
+"""
+
+def test_duplicate_finder():
+    def groups(normalize, min_size=10):
+        finder = DuplicateFinder(min_size=min_size, normalize=normalize)
+        finder.add_tree(ast.parse(clone_sample), 'x.py')
+        return [(size, [(m.type, m.lineno) for m in matches])
+                for size, matches in finder.groups()]
+
+    # Only the largest enclosing duplicate is reported
+    assert groups('literals') == [(24, [('FunctionDef', 1), ('FunctionDef', 8)])]
+    # The functions differ in a constant (x * 2, y * 3)
+    assert groups('names') == []
+    assert groups('names', min_size=4) == [(4, [('Compare', 4), ('Compare', 11)])]
+    assert groups('exact', min_size=2) == []
+
+    with pytest.raises(ValueError):
+        DuplicateFinder(normalize='everything')
+
+def test_duplicate_finder_constant_types():
+    # 1 == True == 1.0, but they're different code
+    source = "f(1, 2, 'abc')\nf(True, 2.0, 'abc')\nf(1, 2, 'abc')\nf(5, 7, 'x')\n"
+    def lines(normalize):
+        finder = DuplicateFinder(min_size=4, normalize=normalize)
+        finder.add_tree(ast.parse(source), 'x.py')
+        return [[m.lineno for m in matches] for _, matches in finder.groups()]
+    assert lines('exact') == [[1, 3]]
+    assert lines('names') == [[1, 3]]
+    # Values are ignored, but not types
+    assert lines('literals') == [[1, 3, 4]]
+
+def test_cli_duplicates(tmp_path, capsys):
+    (tmp_path / 'a.py').write_text(clone_sample)
+    (tmp_path / 'b.py').write_text(clone_sample.replace('total', 'sum'))
+    main(['--duplicates', '--format', 'jsonl', str(tmp_path)])
+    groups = [json.loads(l) for l in capsys.readouterr().out.splitlines()]
+    # f and g are each copied between the two files
+    assert [(g['type'], [m['lineno'] for m in g['matches']]) for g in groups] \
+        == [('FunctionDef', [1, 1]), ('FunctionDef', [8, 8])]
+    assert {m['path'] for m in groups[0]['matches']} == {
+        str(tmp_path / 'a.py'), str(tmp_path / 'b.py')}
+
+
+# Test source buffers -------------------------------------------------------------
+
+def test_source_buffer_lines():
+    src = SourceBuffer(data=b'\xef\xbb\xbfa = 1\r\nb = "\xc3\xa9"\rc = 3\n\nd')
+    assert src.line(1) == 'a = 1'
+    assert src._line_starts == [0, 10]  # Only scanned as far as needed
+    assert src.line(2) == 'b = "é"'
+    assert src.line(3) == 'c = 3'
+    assert src.line(5) == 'd'
+    with pytest.raises(IndexError):
+        src.line(7)
+
+    latin1 = SourceBuffer(data='# coding: latin-1\nx = "\xe9"\n'.encode('latin-1'))
+    assert latin1.line(2) == 'x = "é"'
+
+def test_file_matches_source(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    results = list(apf.iter_file_matches([str(sample_dir / 'a.py'),
+                                          str(sample_dir / 'pkg' / 'b.py')]))
+    assert [len(r.matches) for r in results] == [3, 1]
+    assert results[1].source.line(1) == 'x = 3/4'
+
+    # Pickling drops the data, which is read again from the file if needed
+    source = pickle.loads(pickle.dumps(results[0].source))
+    assert source._data is None
+    assert source.line(3) == '1/2'
+
+def test_match_records(sample_dir):
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    path = str(sample_dir / 'pkg' / 'b.py')
+    for jobs in [1, 2]:
+        matches = list(apf.scan_files([path], jobs=jobs, records=True))
+        assert [m.as_dict() for m in matches] == [{
+            'path': path, 'lineno': 1, 'col_offset': 4, 'end_lineno': 1,
+            'end_col_offset': 7, 'type': 'BinOp',
+        }]
+    assert not hasattr(matches[0], '__dict__')
+    node = matches[0].load_node()
+    assert isinstance(node, ast.BinOp) and node.left.value == 3
+
+    mpf = MultiPatternFinder({'div': prepare_pattern('?/?')})
+    [match] = mpf.scan_files([path], records=True)
+    assert isinstance(match, Match)
+    assert match.rule == 'div'
+
+
+# Test searching archives ------------------------------------------------------------
+
+@pytest.mark.parametrize('fmt', ['zip', 'gztar'])
+def test_scan_archive(sample_dir, tmp_path, fmt):
+    archive = shutil.make_archive(str(tmp_path / 'sample'), fmt, str(sample_dir))
+    names = sorted(name for name, data in iter_archive(archive))
+    assert names == [archive + '!' + n for n in ['a.py', 'build/d.py', 'pkg/b.py']]
+
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+    matches = list(apf.scan_archive(archive, records=True))
+    assert len(matches) == 5
+    b_match = [m for m in matches if m.path.endswith('pkg/b.py')][0]
+    assert b_match.load_node().left.value == 3
+
+def test_cli_archive(sample_dir, tmp_path, capsys):
+    archive = shutil.make_archive(str(tmp_path / 'sample'), 'zip',
+                                  str(sample_dir / 'pkg'))
+    main(['?/?', archive])
+    assert capsys.readouterr().out == archive + '!b.py\n   1│x = 3/4\n\n'
+
+
+# Test output formats ---------------------------------------------------------------
+
+def test_cli_jsonl(sample_dir, capsys):
+    main(['--format', 'jsonl', '--snippets', '?/?', str(sample_dir / 'pkg')])
+    records = [json.loads(l) for l in capsys.readouterr().out.splitlines()]
+    assert records == [{
+        'path': str(sample_dir / 'pkg' / 'b.py'), 'lineno': 1, 'col_offset': 4,
+        'end_lineno': 1, 'end_col_offset': 7, 'type': 'BinOp',
+        'source': 'x = 3/4',
+    }]
+
+def test_cli_null(sample_dir, capsys):
+    main(['--format', 'null', '?/?', str(sample_dir)])
+    paths = capsys.readouterr().out.split('\0')
+    assert sorted(paths) == ['', str(sample_dir / 'a.py'),
+                             str(sample_dir / 'pkg' / 'b.py')]
+
+# Test scan hooks & statistics ------------------------------------------------------
+
+class RecordingHooks(ScanHooks):
+    def __init__(self):
+        self.events = []
+
+    def on_file_start(self, path):
+        self.events.append(('start', os.path.basename(path)))
+
+    def on_parsed(self, path, read_time, parse_time):
+        self.events.append(('parsed', os.path.basename(path), parse_time is None))
+
+    def on_match(self, path, match):
+        self.events.append(('match', os.path.basename(path)))
+
+    def on_file_done(self, path, n_matches, match_time):
+        self.events.append(('done', os.path.basename(path), n_matches))
+
+def test_scan_hooks(sample_dir):
+    (sample_dir / 'bad.py').write_text('x = 1/(\n')
+    (sample_dir / 'other.py').write_text('y = 1\n')
+    hooks = RecordingHooks()
+    apf = ASTPatternFinder(prepare_pattern('x = ?/?'), hooks=hooks)
+    paths = [str(sample_dir / n) for n in ['bad.py', 'other.py', 'pkg/b.py']]
+    with pytest.warns(UserWarning):
+        list(apf.iter_file_matches(paths))
+    assert hooks.events == [
+        ('start', 'bad.py'),
+        ('start', 'other.py'), ('parsed', 'other.py', True), ('done', 'other.py', 0),
+        ('start', 'b.py'), ('parsed', 'b.py', False), ('match', 'b.py'),
+        ('done', 'b.py', 1),
+    ]
+
+class LockedHooks(RecordingHooks):
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def on_match(self, path, match):
+        with self.lock:
+            super().on_match(path, match)
+
+@pytest.mark.parametrize('finder', [ASTPatternFinder, MultiPatternFinder])
+def test_scan_hooks_not_pickled(sample_dir, finder):
+    hooks = LockedHooks()
+    patterns = prepare_pattern('?/?')
+    if finder is MultiPatternFinder:
+        patterns = {'div': patterns}
+    apf = finder(patterns, hooks=hooks)
+    assert pickle.loads(pickle.dumps(apf)).hooks is None
+    # Hooks are called in the parent for results from the workers
+    assert len(list(apf.scan_directory(str(sample_dir), jobs=2))) == 4
+    assert len([e for e in hooks.events if e[0] == 'match']) == 4
+
+def test_cli_stats(sample_dir, capsys):
+    main(['--stats', '-j', '2', '?/?', str(sample_dir)])
+    err = capsys.readouterr().err
+    assert err.startswith('2 files searched')
+    assert '4 matches' in err
+    for phase in ['walk', 'parse', 'match', 'print']:
+        assert '  ' + phase in err
+    assert str(sample_dir / 'a.py') in err
+
+# Test the async API -----------------------------------------------------------------
+
+def test_ascan_directory(sample_dir):
+    import asyncio
+    apf = ASTPatternFinder(prepare_pattern('?/?'))
+
+    async def collect(**kwargs):
+        return [(os.path.relpath(f, str(sample_dir)), n.lineno) async for f, n
+                in apf.ascan_directory(str(sample_dir), **kwargs)]
+
+    matches = asyncio.run(collect(queue_size=1))
+    assert sorted(matches) == sorted((os.path.relpath(f, str(sample_dir)), n.lineno)
+                                     for f, n in apf.scan_directory(str(sample_dir)))
+    assert len(asyncio.run(collect(max_count=2))) == 2
+
+def test_ascan_directory_cancel(tmp_path):
+    import asyncio
+    for i in range(50):
+        (tmp_path / 'f{}.py'.format(i)).write_text('1/2\n')
+    hooks = RecordingHooks()
+    apf = ASTPatternFinder(prepare_pattern('?/?'), hooks=hooks)
+
+    async def first():
+        agen = apf.ascan_directory(str(tmp_path), queue_size=4)
+        try:
+            async for match in agen:
+                return match
+        finally:
+            await agen.aclose()
+
+    filepath, node = asyncio.run(first())
+    assert node.lineno == 1
+    # Only a few files are queued ahead of the consumer
+    assert len([e for e in hooks.events if e[0] == 'start']) <= 8